@@ -0,0 +1,51 @@
+"""
+Compare the combined bot matcher in utils.ua_utils with the per-request loop
+that redirect_url used before.
+
+Run from the project root: python -m benchmarks.bot_detection
+"""
+
+import re
+import timeit
+
+from crawlerdetect import CrawlerDetect
+
+from utils.ua_utils import detect_bot
+from utils.url_utils import BOT_USER_AGENTS
+
+USER_AGENTS = {
+    "browser": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "mobile": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1",
+    "named bot": "Mozilla/5.0 (compatible; AhrefsBot/7.0; +http://ahrefs.com/robot/)",
+    "crawler": "python-requests/2.32.3",
+}
+
+crawler_detect = CrawlerDetect()
+
+
+def legacy_detect_bot(user_agent):
+    for bot in BOT_USER_AGENTS:
+        bot_re = re.compile(bot, re.IGNORECASE)
+        if bot_re.search(user_agent):
+            return re.sub(r"[.$\x00-\x1F\x7F-\x9F]", "_", bot)
+    if crawler_detect.isCrawler(user_agent):
+        return crawler_detect.getMatches()
+    return None
+
+
+def main(number=2000):
+    print(f"{'user agent':<12}{'legacy (us)':>14}{'combined (us)':>16}{'speedup':>10}")
+    for label, user_agent in USER_AGENTS.items():
+        legacy = timeit.timeit(lambda: legacy_detect_bot(user_agent), number=number)
+        combined = timeit.timeit(lambda: detect_bot(user_agent), number=number)
+        print(
+            f"{label:<12}{legacy / number * 1e6:>14.1f}"
+            f"{combined / number * 1e6:>16.1f}{legacy / combined:>9.1f}x"
+        )
+        print(
+            f"{'':<12}-> {legacy_detect_bot(user_agent)!r} / {detect_bot(user_agent)!r}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compare build_dense_series in utils.analytics_utils with the add_missing_dates
+loop it replaced on links of different ages, and check both produce the same
+daily series.
+
+Run from the project root: python -m benchmarks.dense_series
+"""
+
+import random
+import timeit
+from datetime import datetime, timedelta
+
+from utils.analytics_utils import build_dense_series
+
+
+def legacy_add_missing_dates(key, url_data):
+    counter = url_data[key]
+    first_date = datetime.strptime(url_data["creation-date"], "%Y-%m-%d")
+    last_date = datetime.strptime(datetime.now().strftime("%Y-%m-%d"), "%Y-%m-%d")
+    date_range = [
+        first_date + timedelta(days=x) for x in range((last_date - first_date).days + 1)
+    ]
+    all_dates = [date.strftime("%Y-%m-%d") for date in date_range]
+    for date in all_dates:
+        if date not in counter:
+            counter[date] = 0
+    url_data[key] = {date: counter[date] for date in sorted(counter.keys())}
+    return url_data
+
+
+def make_link(age_days, active_ratio=0.3):
+    today = datetime.now()
+    counter = {}
+    for days in range(age_days):
+        if random.random() < active_ratio:
+            day = (today - timedelta(days=days)).strftime("%Y-%m-%d")
+            counter[day] = random.randint(1, 500)
+    unique_counter = {day: max(1, count // 3) for day, count in counter.items()}
+    creation_date = (today - timedelta(days=age_days - 1)).strftime("%Y-%m-%d")
+    return {
+        "creation-date": creation_date,
+        "counter": counter,
+        "unique_counter": unique_counter,
+    }
+
+
+def legacy(link):
+    url_data = {
+        key: dict(value) for key, value in link.items() if key != "creation-date"
+    }
+    url_data["creation-date"] = link["creation-date"]
+    url_data = legacy_add_missing_dates("counter", url_data)
+    url_data = legacy_add_missing_dates("unique_counter", url_data)
+    return url_data["counter"], url_data["unique_counter"]
+
+
+def dense(link, resolution="day"):
+    today = datetime.now().strftime("%Y-%m-%d")
+    return build_dense_series(
+        [link["counter"], link["unique_counter"]],
+        link["creation-date"],
+        today,
+        resolution,
+    )
+
+
+def main(number=200):
+    print(f"{'age (days)':<12}{'legacy (ms)':>12}{'numpy (ms)':>12}{'speedup':>10}")
+    for age in (30, 365, 3 * 365, 10 * 365):
+        link = make_link(age)
+        assert list(legacy(link)) == dense(link), f"series differ at {age} days"
+        old = timeit.timeit(lambda: legacy(link), number=number)
+        new = timeit.timeit(lambda: dense(link), number=number)
+        print(
+            f"{age:<12}{old / number * 1e3:>12.3f}"
+            f"{new / number * 1e3:>12.3f}{old / new:>9.1f}x"
+        )
+
+    link = make_link(3 * 365)
+    for resolution in ("week", "month"):
+        new = timeit.timeit(lambda: dense(link, resolution), number=number)
+        print(f"{resolution:<12}{'':>12}{new / number * 1e3:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compare the trie based validate_emoji_alias in utils.url_utils with the
+emoji.emoji_list version it replaced, and check both agree on every emoji
+sequence known to the emoji library plus a few edge cases.
+
+Run from the project root: python -m benchmarks.emoji_alias
+"""
+
+import random
+import timeit
+from urllib.parse import quote, unquote
+
+import emoji
+
+from emojies import EMOJIES
+from utils.url_utils import generate_emoji_alias, validate_emoji_alias
+
+ALIASES = {
+    "short code": "aZ3kQ9",
+    "custom alias": "my-campaign_2024",
+    "emoji alias": "😀🚀🎉",
+    "zwj alias": "👨‍👩‍👧‍👦😶‍🌫️🏳️‍🌈",
+    "encoded": quote("😀🚀🎉"),
+}
+
+
+def legacy_validate_emoji_alias(alias):
+    alias = unquote(alias)
+    emoji_list = emoji.emoji_list(alias)
+    extracted_emojis = "".join([data["emoji"] for data in emoji_list])
+    if len(extracted_emojis) != len(alias) or len(emoji_list) > 15:
+        return False
+    else:
+        return True
+
+
+def check_agreement():
+    samples = list(emoji.EMOJI_DATA)
+    samples += [generate_emoji_alias() for _ in range(2000)]
+    samples += ["".join(random.choices(EMOJIES, k=k)) for k in range(1, 20)]
+    samples += [
+        "",
+        "abc",
+        "😀a",
+        "a😀",
+        "😀‍😀",
+        "️",
+        "😀️",
+        "☺",
+        "☺️",
+        "ñ",
+        *ALIASES.values(),
+    ]
+    mismatches = [
+        sample
+        for sample in samples
+        if legacy_validate_emoji_alias(sample) != validate_emoji_alias(sample)
+    ]
+    print(f"checked {len(samples)} aliases, {len(mismatches)} mismatches")
+    for sample in mismatches[:10]:
+        print(f"  {sample!r}")
+
+
+def main(number=20000):
+    check_agreement()
+    print(f"{'alias':<14}{'legacy (us)':>14}{'trie (us)':>12}{'speedup':>10}")
+    for label, alias in ALIASES.items():
+        legacy = timeit.timeit(
+            lambda: legacy_validate_emoji_alias(alias), number=number
+        )
+        trie = timeit.timeit(lambda: validate_emoji_alias(alias), number=number)
+        print(
+            f"{label:<14}{legacy / number * 1e6:>14.2f}"
+            f"{trie / number * 1e6:>12.2f}{legacy / trie:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
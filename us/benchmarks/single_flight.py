@@ -0,0 +1,49 @@
+"""
+Threaded load generator for utils.cache_utils.SingleFlight: many threads look
+up the same few keys at once against a slow loader and the number of loader
+calls is compared with the number of lookups.
+
+Run from the project root: python -m benchmarks.single_flight
+"""
+
+import threading
+import time
+
+from utils.cache_utils import SingleFlight
+
+THREADS = 200
+KEYS = 4
+QUERY_TIME = 0.05
+
+
+def main():
+    single_flight = SingleFlight()
+    queries = []
+    barrier = threading.Barrier(THREADS)
+
+    def find_one(key):
+        queries.append(key)
+        time.sleep(QUERY_TIME)
+        return {"_id": key}
+
+    def worker(i):
+        key = f"code-{i % KEYS}"
+        barrier.wait()
+        result, _ = single_flight.do(key, find_one, key)
+        assert result == {"_id": key}
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"lookups: {THREADS}, database queries: {len(queries)}")
+    print(f"stats: {single_flight.stats()}, elapsed: {elapsed:.3f}s")
+    assert len(queries) <= THREADS // 2, "concurrent lookups were not collapsed"
+
+
+if __name__ == "__main__":
+    main()
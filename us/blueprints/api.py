@@ -1,6 +1,25 @@
-from flask import Blueprint, render_template, request
+import json
+import os
+from flask import Blueprint, Response, render_template, request, stream_with_context
+from utils.url_utils import get_client_ip
+from utils.mongo_utils import (
+    blocked_url_cache,
+    find_url_by_destination,
+    insert_urls,
+    short_code_allocator,
+)
+from utils.click_utils import click_writer
+from utils.link_utils import build_link
+from utils.metrics_utils import stage_duration
 from .limiter import limiter
 
+# links are validated and inserted BULK_BATCH_SIZE at a time, the links of a
+# request after the first BULK_MAX_LINKS get an error instead
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 500))
+BULK_MAX_LINKS = int(os.environ.get("BULK_MAX_LINKS", 100000))
+# the whole request counts as one hit, whatever the number of links
+BULK_RATE_LIMIT = os.environ.get("BULK_RATE_LIMIT", "10 per minute")
+
 api = Blueprint("api", __name__)
 
 
@@ -8,3 +27,171 @@ api = Blueprint("api", __name__)
 @limiter.exempt
 def api_route():
     return render_template("api.html", host_url=request.host_url)
+
+
+def _read_specs():
+    """
+    Yield ``(index, spec)`` for every link of a JSON array or NDJSON body,
+    ``spec`` is None for lines that aren't a JSON object. Lines after the first
+    BULK_MAX_LINKS aren't parsed.
+    """
+    if request.mimetype == "application/json":
+        specs = request.get_json(silent=True)
+        if not isinstance(specs, list):
+            specs = [specs]
+        for index, spec in enumerate(specs):
+            yield index, spec if isinstance(spec, dict) else None
+        return
+
+    index = 0
+    for line in request.stream:
+        if not line.strip():
+            continue
+        if index >= BULK_MAX_LINKS:
+            yield index, None
+            index += 1
+            continue
+        try:
+            spec = json.loads(line)
+        except ValueError:
+            spec = None
+        yield index, spec if isinstance(spec, dict) else None
+        index += 1
+
+
+def _build_link(spec, matcher, creation_ip):
+    """
+    Validate a link spec the way shorten_url does, returns ``(alias, data,
+    error)``.
+    """
+    if spec is None:
+        return None, None, {"JsonError": "Every link must be a JSON object"}
+    alias, data, error = build_link(spec, matcher.is_blocked, creation_ip)
+    return alias[:11] if alias else None, data, error
+
+
+def _create_batch(batch, matcher, creation_ip):
+    """
+    Validate and insert a batch of ``(index, spec)`` pairs, returns the result
+    of every link by index.
+    """
+    results = {}
+    pending = []
+    with stage_duration.time("bulk_create", "validation"):
+        for index, spec in batch:
+            alias, data, error = _build_link(spec, matcher, creation_ip)
+            if error:
+                results[index] = {"index": index, **error}
+            else:
+                pending.append((index, alias, data))
+
+    # identical links share a code with DEDUP_DESTINATIONS, with a link saved
+    # before or with the first of them in the batch
+    shared = {}
+    followers = []
+    if any("destination-hash" in data for _, _, data in pending):
+        with stage_duration.time("bulk_create", "dedup_lookup"):
+            unique = []
+            for item in pending:
+                index, _, data = item
+                destination_hash = data.get("destination-hash")
+                if destination_hash is None:
+                    unique.append(item)
+                elif destination_hash in shared:
+                    followers.append((index, shared[destination_hash]))
+                else:
+                    shared[destination_hash] = index
+                    existing = find_url_by_destination(destination_hash)
+                    if existing is None:
+                        unique.append(item)
+                    else:
+                        results[index] = {
+                            "index": index,
+                            "short_url": f"{request.host_url}{existing}",
+                        }
+            pending = unique
+
+    while pending:
+        with stage_duration.time("bulk_create", "code_allocation"):
+            codes = [
+                alias or short_code_allocator.allocate() for _, alias, _ in pending
+            ]
+        with stage_duration.time("bulk_create", "insert"):
+            try:
+                duplicates, failed = insert_urls(
+                    [
+                        {"_id": code, **data}
+                        for code, (_, _, data) in zip(codes, pending)
+                    ]
+                )
+            except Exception as e:
+                print(f"Error inserting a batch of links: {e}")
+                duplicates, failed = set(), set(range(len(pending)))
+        click_writer.count_links(
+            is_emoji=False, count=len(pending) - len(duplicates) - len(failed)
+        )
+
+        # generated codes that collided get a new code in the next round
+        retry = []
+        for position, (code, item) in enumerate(zip(codes, pending)):
+            index, alias, _ = item
+            if position in failed:
+                results[index] = {"index": index, "InsertError": "Could not save URL"}
+            elif position in duplicates and alias:
+                results[index] = {
+                    "index": index,
+                    "AliasError": "Alias already exists",
+                    "alias": alias,
+                }
+            elif position in duplicates:
+                retry.append(item)
+            else:
+                results[index] = {
+                    "index": index,
+                    "short_url": f"{request.host_url}{code}",
+                }
+        pending = retry
+
+    for index, first in followers:
+        results[index] = {**results[first], "index": index}
+    return [results[index] for index, _ in batch]
+
+
+@api.route("/api/bulk", methods=["POST"])
+@limiter.limit(BULK_RATE_LIMIT)
+def bulk_create():
+    """
+    Create many short urls at once. The body is a JSON array or NDJSON stream
+    of link specs with the fields of the shorten form, the response streams
+    one NDJSON result per link, in order. Links after the first BULK_MAX_LINKS
+    aren't created and get a LimitError.
+    """
+    creation_ip = get_client_ip()
+
+    def generate():
+        # every link of the request is checked against the same blocklist
+        matcher = blocked_url_cache.get()
+        batch = []
+        for item in _read_specs():
+            index, _ = item
+            if index >= BULK_MAX_LINKS:
+                # the results stay in order, the last batch goes first
+                for result in _create_batch(batch, matcher, creation_ip):
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+                batch = []
+                result = {
+                    "index": index,
+                    "LimitError": f"At most {BULK_MAX_LINKS} links per request",
+                }
+                yield json.dumps(result) + "\n"
+                continue
+            batch.append(item)
+            if len(batch) >= BULK_BATCH_SIZE:
+                for result in _create_batch(batch, matcher, creation_ip):
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+                batch = []
+        if batch:
+            for result in _create_batch(batch, matcher, creation_ip):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
@@ -1,12 +1,28 @@
+import os
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from utils.mongo_utils import MONGO_URI, ip_bypasses
+from utils.mongo_utils import MONGO_URI, is_ip_bypassed
+from utils.ratelimit_utils import ReconcilingStorage  # noqa: F401 registers local+mongodb://
 from flask import request
 
+# "mongodb" counts every hit in MongoDB, "local" counts in memory and syncs the
+# counts to MongoDB every RATELIMIT_SYNC_INTERVAL seconds, see
+# ReconcilingStorage for how far over a limit that can go
+RATELIMIT_STORAGE = os.environ.get("RATELIMIT_STORAGE", "mongodb")
+RATELIMIT_SYNC_INTERVAL = float(os.environ.get("RATELIMIT_SYNC_INTERVAL", 1))
+
+if RATELIMIT_STORAGE == "local":
+    storage_uri = f"local+{MONGO_URI}"
+    storage_options = {"sync_interval": RATELIMIT_SYNC_INTERVAL}
+else:
+    storage_uri = MONGO_URI
+    storage_options = {}
+
 limiter = Limiter(
     key_func=get_remote_address,
     default_limits=["5 per minute", "500 per day", "50 per hour"],
-    storage_uri=MONGO_URI,
+    storage_uri=storage_uri,
+    storage_options=storage_options,
     strategy="fixed-window",
 )
 
@@ -16,7 +32,4 @@ def ip_whitelist():
     if request.method == "GET":
         return True
 
-    bypasses = ip_bypasses.find()
-    bypasses = [doc["_id"] for doc in bypasses]
-
-    return request.remote_addr in bypasses
+    return is_ip_bypassed(request.remote_addr)
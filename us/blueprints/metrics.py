@@ -0,0 +1,171 @@
+import time
+from flask import Blueprint, Response, g, request
+from utils.metrics_utils import request_duration, stage_duration, render_gauges
+from utils.mongo_utils import (
+    route_cache,
+    single_flight,
+    short_code_filter,
+    blocked_url_cache,
+)
+from utils.url_utils import get_country_cache_info, get_referrer_cache_info
+from utils.ua_utils import ua_cache
+from utils.click_utils import click_writer
+from utils.summary_utils import stats_rollup
+from utils.counter_utils import global_counters_reconciler
+from .stats import stats_payload_cache
+from .limiter import limiter
+
+metrics = Blueprint("metrics", __name__)
+
+
+@metrics.before_app_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@metrics.teardown_app_request
+def record_request_duration(error=None):
+    start = g.pop("request_start", None)
+    if start is None:
+        return
+    request_duration.observe(
+        time.perf_counter() - start, request.endpoint or "unmatched"
+    )
+
+
+def _cache_gauges():
+    caches = {
+        "route": route_cache.stats(),
+        "user_agent": ua_cache.stats(),
+        "country": get_country_cache_info(),
+        "referrer": get_referrer_cache_info(),
+        "stats_payload": stats_payload_cache.stats(),
+    }
+    return [
+        render_gauges(
+            f"url_shortener_cache_{field}",
+            f"Cache {field} since the process started.",
+            [
+                ({"cache": name}, stats[field])
+                for name, stats in caches.items()
+                # the functools caches don't track evictions or expirations
+                if field in stats
+            ],
+        )
+        for field in (
+            "hits",
+            "misses",
+            "hit_ratio",
+            "evictions",
+            "expirations",
+            "size",
+            "maxsize",
+        )
+    ]
+
+
+def _click_writer_gauges():
+    return [
+        render_gauges(
+            "url_shortener_click_writer",
+            "Click write-behind queue counters.",
+            [
+                ({"field": field}, value)
+                for field, value in click_writer.stats().items()
+            ],
+        )
+    ]
+
+
+def _single_flight_gauges():
+    return [
+        render_gauges(
+            "url_shortener_single_flight",
+            "Collapsed database calls.",
+            [
+                ({"field": field}, value)
+                for field, value in single_flight.stats().items()
+            ],
+        )
+    ]
+
+
+def _short_code_filter_gauges():
+    if short_code_filter is None:
+        return []
+    stats = short_code_filter.stats()
+    return [
+        render_gauges(
+            "url_shortener_short_code_filter",
+            "Bloom filter of existing short codes.",
+            [
+                ({"field": field}, float(value))
+                for field, value in stats.items()
+                if isinstance(value, (bool, int, float))
+            ],
+        )
+    ]
+
+
+def _blocklist_gauges():
+    stats = blocked_url_cache.stats()
+    matcher = blocked_url_cache.value
+    if matcher is not None:
+        stats["entries"] = len(matcher)
+        stats["invalid"] = len(matcher.invalid)
+    return [
+        render_gauges(
+            "url_shortener_blocklist",
+            "Blocked url matcher.",
+            [
+                ({"field": field}, value)
+                for field, value in stats.items()
+                if isinstance(value, int)
+            ],
+        )
+    ]
+
+
+def _stats_rollup_gauges():
+    if stats_rollup is None:
+        return []
+    return [
+        render_gauges(
+            "url_shortener_stats_rollup",
+            "Stats summary roll-up counters.",
+            [
+                ({"field": field}, value)
+                for field, value in stats_rollup.stats().items()
+            ],
+        )
+    ]
+
+
+def _global_counters_gauges():
+    return [
+        render_gauges(
+            "url_shortener_global_counters_reconciler",
+            "Reconciliations of the /metric totals by this process.",
+            [
+                ({"field": field}, value)
+                for field, value in global_counters_reconciler.stats().items()
+            ],
+        )
+    ]
+
+
+@metrics.route("/metrics", methods=["GET"])
+@limiter.exempt
+def metrics_route():
+    sections = [
+        request_duration.render(),
+        stage_duration.render(),
+        *_cache_gauges(),
+        *_click_writer_gauges(),
+        *_single_flight_gauges(),
+        *_short_code_filter_gauges(),
+        *_blocklist_gauges(),
+        *_stats_rollup_gauges(),
+        *_global_counters_gauges(),
+    ]
+    return Response("\n".join(sections) + "\n", mimetype="text/plain; version=0.0.4")
@@ -1,9 +1,17 @@
-from flask import Blueprint, jsonify, render_template, request, redirect
+from flask import (
+    Blueprint,
+    Response,
+    jsonify,
+    make_response,
+    render_template,
+    request,
+    redirect,
+)
 from utils.mongo_utils import (
-    aggregate_emoji_url,
-    aggregate_url,
+    CLICK_BUCKETS,
     load_url,
     load_emoji_url,
+    load_click_buckets,
 )
 from utils.url_utils import (
     validate_emoji_alias,
@@ -11,9 +19,14 @@ from utils.url_utils import (
 )
 from utils.analytics_utils import (
     calculate_click_averages,
-    add_missing_dates,
+    build_dense_series,
     top_four,
     convert_country_data,
+    get_window_start,
+    build_click_series,
+    STATS_WINDOWS,
+    SERIES_KEY_FORMATS,
+    series_key,
 )
 from utils.export_utils import (
     export_to_csv,
@@ -21,15 +34,241 @@ from utils.export_utils import (
     export_to_excel,
     export_to_xml,
 )
-from utils.pipeline_utils import get_stats_pipeline
+from utils.summary_utils import load_stats, load_stats_version
+from utils.cache_utils import LRUCache
+from utils.hll_utils import resolve_unique_counts
+from utils.pipeline_utils import STATS_DIMENSIONS
+from utils.metrics_utils import stage_duration
 from .limiter import limiter
 
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from urllib.parse import unquote
+import hashlib
 import json
+import os
 
 stats = Blueprint("stats", __name__)
 
+# rendered stats pages and exports by ETag, so polling an unchanged link costs
+# one indexed read
+STATS_CACHE_SIZE = int(os.environ.get("STATS_CACHE_SIZE", 1000))
+stats_payload_cache = LRUCache(STATS_CACHE_SIZE)
+
+WINDOW_ERROR = "Invalid window, window must be 7, 30 or 90 days and granularity hour, day, week or month"
+SELECTION_ERROR = "Invalid selection, fields must be stats fields separated by commas, top a positive integer and since and until dates in YYYY-MM-DD format, at most 90 days apart with click buckets"
+
+# fields the stats API can be asked for with fields=a,b,c
+STATS_FIELDS = (
+    "url",
+    "total-clicks",
+    "total_unique_clicks",
+    "max-clicks",
+    "expiration-time",
+    "password",
+    "block-bots",
+    "bots",
+    "counter",
+    "unique_counter",
+    "average_redirection_time",
+    "creation-date",
+    "creation-time",
+    "last-click",
+    "last-click-browser",
+    "last-click-os",
+    "last-click-country",
+    *STATS_DIMENSIONS,
+    *(f"unique_{field}" for field in STATS_DIMENSIONS),
+    "expired",
+    "average_daily_clicks",
+    "average_weekly_clicks",
+    "average_monthly_clicks",
+    "short_code",
+    "window",
+    "granularity",
+)
+
+
+def parse_window():
+    """
+    Return the ``(days, granularity)`` of the click series asked for with the
+    window and granularity parameters, or None if they are invalid. Without
+    click buckets the series cover the whole life of the link in days or
+    longer periods, ``days`` is None then.
+    """
+    granularity = request.values.get("granularity", "day")
+    if granularity not in SERIES_KEY_FORMATS:
+        return None
+    if not CLICK_BUCKETS:
+        return (None, granularity) if granularity != "hour" else None
+
+    window = request.values.get("window", str(STATS_WINDOWS[-1]))
+    if not window.isdigit() or int(window) not in STATS_WINDOWS:
+        return None
+    return int(window), granularity
+
+
+def parse_selection():
+    """
+    Return the fields, top values per dimension and date range asked for with
+    the fields, top, since and until parameters as get_stats_pipeline
+    arguments, or None if they are invalid.
+    """
+    selection = {}
+    fields = request.values.get("fields")
+    if fields:
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+        if not fields or any(field not in STATS_FIELDS for field in fields):
+            return None
+        selection["fields"] = fields
+
+    top = request.values.get("top")
+    if top:
+        if not top.isdigit() or int(top) < 1:
+            return None
+        selection["top"] = int(top)
+
+    for name in ("since", "until"):
+        value = request.values.get(name)
+        if value:
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return None
+            selection[name] = value
+
+    since = selection.get("since")
+    until = selection.get("until") or datetime.now().strftime("%Y-%m-%d")
+    if since:
+        if since > until:
+            return None
+        # bucket reads stay bounded like the windows
+        span = datetime.strptime(until, "%Y-%m-%d") - datetime.strptime(
+            since, "%Y-%m-%d"
+        )
+        if CLICK_BUCKETS and span.days >= STATS_WINDOWS[-1]:
+            return None
+    return selection
+
+
+def stats_etag(short_code, window, *variant):
+    """
+    Return the ETag of the stats response for a link, or None if the link
+    doesn't exist or the password doesn't match. The response changes with
+    the clicks and route fields of the link, the current day (or hour) the
+    series and averages run to and whether the link expired by now.
+    """
+    version = load_stats_version(short_code, validate_emoji_alias(short_code))
+    if version is None:
+        return None
+    if version.get("password") is not None:
+        if version["password"] != request.values.get("password"):
+            return None
+
+    expired = False
+    if version.get("expiration-time") is not None:
+        expiration_time = convert_to_gmt(version["expiration-time"])
+        expired = bool(expiration_time) and expiration_time <= datetime.now(
+            timezone.utc
+        )
+
+    days, granularity = window
+    now = datetime.now().astimezone()
+    token = json.dumps(
+        [
+            short_code,
+            version,
+            expired,
+            days,
+            granularity,
+            series_key(now, "hour" if granularity == "hour" else "day"),
+            request.method,
+            request.host_url,
+            *variant,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+def cached_stats_response(etag):
+    if etag is None:
+        return None
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        cached = stats_payload_cache.get(etag)
+        if cached is None:
+            return None
+        body, headers = cached
+        response = Response(body, headers=headers)
+    response.set_etag(etag)
+    return response
+
+
+def cache_stats_response(etag, response):
+    response = make_response(response)
+    if etag is None or response.status_code != 200:
+        return response
+    # exports are sent as files, read them once to keep a copy
+    response.direct_passthrough = False
+    headers = [
+        (name, value)
+        for name, value in response.headers
+        if name in ("Content-Type", "Content-Disposition")
+    ]
+    stats_payload_cache.set(etag, (response.get_data(), headers))
+    response.set_etag(etag)
+    return response
+
+
+def add_click_series(short_code, url_data, window, since=None, until=None):
+    """
+    Replace the counters of ``url_data`` with dense series over the window,
+    or from ``since`` to ``until`` when a date range was asked for.
+    """
+    days, granularity = window
+    if "counter" not in url_data and "unique_counter" not in url_data:
+        return url_data
+    counter = url_data.get("counter", {})
+    unique_counter = url_data.get("unique_counter", {})
+
+    if not CLICK_BUCKETS:
+        # the series is empty when until is before the link was created
+        today = datetime.now().strftime("%Y-%m-%d")
+        first_day = since or min(
+            url_data["creation-date"] or today,
+            min(counter, default=today),
+            min(unique_counter, default=today),
+        )
+        url_data["counter"], url_data["unique_counter"] = build_dense_series(
+            [counter, unique_counter], first_day, until or today, granularity
+        )
+    else:
+        end = None
+        if until:
+            # up to the end of until, local time
+            end = datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1)
+            end = end.astimezone(timezone.utc)
+        if since:
+            # from local midnight of since
+            start = datetime.strptime(since, "%Y-%m-%d").astimezone(timezone.utc)
+            days = None
+        else:
+            # the window ends with until
+            start = get_window_start(
+                days, granularity, end and end - timedelta(hours=1)
+            )
+        buckets = load_click_buckets(
+            short_code, validate_emoji_alias(short_code), start, end
+        )
+        url_data["counter"], url_data["unique_counter"] = build_click_series(
+            buckets, start, granularity, end and end - timedelta(hours=1)
+        )
+    url_data["window"] = days
+    url_data["granularity"] = granularity
+    return url_data
+
 
 @stats.route("/stats", methods=["GET", "POST"])
 @stats.route("/stats/", methods=["GET", "POST"])
@@ -104,12 +343,38 @@ def stats_route():
 def analytics(short_code):
     password = request.values.get("password")
     short_code = unquote(short_code)
-    pipeline = get_stats_pipeline(short_code)
 
-    if validate_emoji_alias(short_code):
-        url_data = aggregate_emoji_url(pipeline)
-    else:
-        url_data = aggregate_url(pipeline)
+    window = parse_window()
+    if window is None:
+        if request.method == "GET":
+            return (
+                render_template(
+                    "error.html",
+                    error_code="400",
+                    error_message=WINDOW_ERROR,
+                    host_url=request.host_url,
+                ),
+                400,
+            )
+        else:
+            return jsonify({"WindowError": WINDOW_ERROR}), 400
+
+    selection = {}
+    if request.method == "POST":
+        selection = parse_selection()
+        if selection is None:
+            return jsonify({"SelectionError": SELECTION_ERROR}), 400
+
+    with stage_duration.time("analytics", "version"):
+        etag = stats_etag(short_code, window, selection)
+    response = cached_stats_response(etag)
+    if response is not None:
+        return response
+
+    with stage_duration.time("analytics", "aggregate"):
+        url_data = load_stats(
+            short_code, validate_emoji_alias(short_code), selection
+        )
 
     if not url_data:
         if request.method == "GET":
@@ -172,6 +437,7 @@ def analytics(short_code):
             url_data["expired"] = True
 
     url_data["short_code"] = short_code
+    url_data = resolve_unique_counts(url_data)
 
     (
         url_data["average_daily_clicks"],
@@ -180,13 +446,23 @@ def analytics(short_code):
     ) = calculate_click_averages(url_data)
     url_data["average_redirection_time"] = url_data.get("average_redirection_time", 0)
 
-    if url_data["counter"] != {}:
-        url_data = add_missing_dates("counter", url_data)
-    if "unique_counter" in url_data and url_data["unique_counter"] != {}:
-        url_data = add_missing_dates("unique_counter", url_data)
+    with stage_duration.time("analytics", "click_series"):
+        url_data = add_click_series(
+            short_code,
+            url_data,
+            window,
+            selection.get("since"),
+            selection.get("until"),
+        )
 
     if request.method == "POST":
-        return jsonify(url_data)
+        if selection.get("fields"):
+            url_data = {
+                field: url_data[field]
+                for field in selection["fields"]
+                if field in url_data
+            }
+        return cache_stats_response(etag, jsonify(url_data))
     else:
         try:
             url_data["hyper_link"] = url_data["url"]
@@ -210,9 +486,11 @@ def analytics(short_code):
             }
         except Exception:
             pass
-        return render_template(
-            "stats_view.html", json_data=url_data, host_url=request.host_url
-        )
+        with stage_duration.time("analytics", "render"):
+            page = render_template(
+                "stats_view.html", json_data=url_data, host_url=request.host_url
+            )
+        return cache_stats_response(etag, page)
 
 
 @stats.route("/export/<short_code>/<format>", methods=["GET", "POST"])
@@ -221,7 +499,6 @@ def export(short_code, format):
     format = format.lower()
     password = request.values.get("password")
     short_code = unquote(short_code)
-    pipeline = get_stats_pipeline(short_code)
 
     if format not in ["csv", "json", "xlsx", "xml"]:
         if request.method == "GET":
@@ -244,10 +521,29 @@ def export(short_code, format):
                 400,
             )
 
-    if validate_emoji_alias(short_code):
-        url_data = aggregate_emoji_url(pipeline)
-    else:
-        url_data = aggregate_url(pipeline)
+    window = parse_window()
+    if window is None:
+        if request.method == "GET":
+            return (
+                render_template(
+                    "error.html",
+                    error_code="400",
+                    error_message=WINDOW_ERROR,
+                    host_url=request.host_url,
+                ),
+                400,
+            )
+        else:
+            return jsonify({"WindowError": WINDOW_ERROR}), 400
+
+    with stage_duration.time("export", "version"):
+        etag = stats_etag(short_code, window, format)
+    response = cached_stats_response(etag)
+    if response is not None:
+        return response
+
+    with stage_duration.time("export", "aggregate"):
+        url_data = load_stats(short_code, validate_emoji_alias(short_code))
 
     if not url_data:
         if request.method == "GET":
@@ -287,6 +583,7 @@ def export(short_code, format):
                 )
 
     url_data["short_code"] = short_code
+    url_data = resolve_unique_counts(url_data)
 
     if url_data["max-clicks"] is not None:
         url_data["expired"] = url_data["total-clicks"] >= int(url_data["max-clicks"])
@@ -306,17 +603,16 @@ def export(short_code, format):
         url_data["average_monthly_clicks"],
     ) = calculate_click_averages(url_data)
 
-    if url_data["counter"] != {}:
-        url_data = add_missing_dates("counter", url_data)
-
-    if url_data["unique_counter"] != {}:
-        url_data = add_missing_dates("unique_counter", url_data)
-
-    if format == "json":
-        return export_to_json(url_data)
-    elif format == "csv":
-        return export_to_csv(url_data)
-    elif format == "xlsx":
-        return export_to_excel(url_data)
-    elif format == "xml":
-        return export_to_xml(url_data)
+    with stage_duration.time("export", "click_series"):
+        url_data = add_click_series(short_code, url_data, window)
+
+    with stage_duration.time("export", format):
+        if format == "json":
+            response = export_to_json(url_data)
+        elif format == "csv":
+            response = export_to_csv(url_data)
+        elif format == "xlsx":
+            response = export_to_excel(url_data)
+        elif format == "xml":
+            response = export_to_xml(url_data)
+    return cache_stats_response(etag, response)
@@ -9,48 +9,44 @@ from flask import (
     make_response,
 )
 from utils.url_utils import (
-    BOT_USER_AGENTS,
     get_country,
     get_client_ip,
+    get_referrer_key,
     validate_password,
     validate_url,
-    validate_alias,
     validate_emoji_alias,
     validate_expiration_time,
-    generate_short_code,
     generate_emoji_alias,
     convert_to_gmt,
 )
 from utils.mongo_utils import (
     load_url,
-    update_url,
     insert_url,
     load_emoji_url,
-    update_emoji_url,
     insert_emoji_url,
-    check_if_slug_exists,
-    check_if_emoji_alias_exists,
     validate_blocked_url,
-    urls_collection,
+    reserve_url_click,
+    reserve_emoji_url_click,
+    short_code_allocator,
+    find_url_by_destination,
+    ROUTE_PROJECTION,
 )
 from utils.general import is_positive_integer, humanize_number
 from utils.qr_utils import generate_qr_code
+from utils.ua_utils import classify_user_agent
+from utils.click_utils import ClickEvent, click_writer
+from utils.link_utils import build_link
+from utils.counter_utils import load_metric_totals
+from utils.metrics_utils import stage_duration
 from .limiter import limiter
 from .cache import cache
 
-from user_agents import parse
 import json
 from datetime import datetime, timezone
 from urllib.parse import unquote
-import re
-import tldextract
-from crawlerdetect import CrawlerDetect
 
 url_shortener = Blueprint("url_shortener", __name__)
 
-crawler_detect = CrawlerDetect()
-tld_no_cache_extract = tldextract.TLDExtract(cache_dir=None)
-
 
 @url_shortener.route("/", methods=["GET"])
 @limiter.exempt
@@ -64,138 +60,85 @@ def index():
     )
 
 
-@url_shortener.route("/", methods=["POST"])
-def shorten_url():
-    url = request.values.get("url")
-    password = request.values.get("password")
-    max_clicks = request.values.get("max-clicks")
-    alias = request.values.get("alias")
-    expiration_time = request.values.get("expiration-time")
-    block_bots = request.values.get("block-bots")
+def _is_blocked(url):
+    with stage_duration.time("shorten_url", "blocklist"):
+        return not validate_blocked_url(url)
 
-    if not url:
-        if request.headers.get("Accept") == "application/json":
-            return jsonify({"UrlError": "URL is required"}), 400
-        else:
-            return (
-                render_template(
-                    "index.html",
-                    error="URL is required",
-                    host_url=request.host_url,
-                ),
-                400,
-            )
 
-    if url and not validate_url(url):
-        return (
-            jsonify(
-                {
-                    "UrlError": "Invalid URL, URL must have a valid protocol and must follow rfc_1034 & rfc_2728 patterns"
-                }
-            ),
-            400,
-        )
-
-    if url and not validate_blocked_url(url):
-        return jsonify({"BlockedUrlError": "Blocked URL ⛔"}), 403
-
-    if alias and not validate_alias(alias):
-        if request.headers.get("Accept") == "application/json":
-            return jsonify({"AliasError": "Invalid Alias", "alias": f"{alias}"}), 400
-        else:
-            return (
-                render_template(
-                    "index.html",
-                    error="Invalid Alias",
-                    url=url,
-                    host_url=request.host_url,
-                ),
-                400,
-            )
+@url_shortener.route("/", methods=["POST"])
+def shorten_url():
+    alias, data, error = build_link(request.values, _is_blocked, get_client_ip())
+    if error:
+        # the form gets the page back for the errors it can fix
+        if request.headers.get("Accept") != "application/json":
+            if error.get("UrlError") == "URL is required":
+                return (
+                    render_template(
+                        "index.html",
+                        error="URL is required",
+                        host_url=request.host_url,
+                    ),
+                    400,
+                )
+            if "AliasError" in error:
+                return (
+                    render_template(
+                        "index.html",
+                        error=error["AliasError"],
+                        url=request.values.get("url"),
+                        host_url=request.host_url,
+                    ),
+                    400,
+                )
+        return jsonify(error), 403 if "BlockedUrlError" in error else 400
 
-    elif alias:
+    url = data["url"]
+    if alias:
         short_code = alias[:11]
 
-    if alias and check_if_slug_exists(alias[:11]):
-        if request.headers.get("Accept") == "application/json":
-            return (
-                jsonify({"AliasError": "Alias already exists", "alias": f"{alias}"}),
-                400,
-            )
-        else:
-            return (
-                render_template(
-                    "index.html",
-                    error="Alias already exists",
-                    url=url,
-                    host_url=request.host_url,
-                ),
-                400,
-            )
+    existing = None
+    if "destination-hash" in data:
+        with stage_duration.time("shorten_url", "dedup_lookup"):
+            existing = find_url_by_destination(data["destination-hash"])
+
+    if existing is not None:
+        short_code = existing
     elif alias:
-        short_code = alias[:11]
+        # the insert fails on a duplicate key when the alias is taken
+        with stage_duration.time("shorten_url", "insert"):
+            inserted = insert_url(short_code, data)
+        if not inserted:
+            if request.headers.get("Accept") == "application/json":
+                return (
+                    jsonify(
+                        {"AliasError": "Alias already exists", "alias": f"{alias}"}
+                    ),
+                    400,
+                )
+            else:
+                return (
+                    render_template(
+                        "index.html",
+                        error="Alias already exists",
+                        url=url,
+                        host_url=request.host_url,
+                    ),
+                    400,
+                )
     else:
+        # generated codes can only collide with aliases or links from before
+        # the allocator, take the next code when they do
         while True:
-            short_code = generate_short_code()
+            with stage_duration.time("shorten_url", "code_allocation"):
+                short_code = short_code_allocator.allocate()
 
-            if not check_if_slug_exists(short_code):
+            with stage_duration.time("shorten_url", "insert"):
+                inserted = insert_url(short_code, data)
+            if inserted:
                 break
 
-    if password:
-        if not validate_password(password):
-            return (
-                jsonify(
-                    {
-                        "PasswordError": "Invalid password, password must be atleast 8 characters long, must contain a letter and a number and a special character either '@' or '.' and cannot be consecutive"
-                    }
-                ),
-                400,
-            )
-
-        data = {
-            "url": url,
-            "password": password,
-            "counter": {},
-            "total-clicks": 0,
-            "ips": [],
-        }
-    else:
-        data = {"url": url, "counter": {}, "total-clicks": 0, "ips": []}
-
-    if max_clicks:
-        if not is_positive_integer(max_clicks):
-            return (
-                jsonify({"MaxClicksError": "max-clicks must be an positive integer"}),
-                400,
-            )
-        else:
-            max_clicks = str(abs(int(str(max_clicks))))
-        data["max-clicks"] = max_clicks
-
-    # custom expiration time is currently really buggy and not ready for production
-
-    if expiration_time:
-        if not validate_expiration_time(expiration_time):
-            return (
-                jsonify(
-                    {
-                        "ExpirationTimeError": "Invalid expiration-time. It must be in a valid ISO format with timezone information and at least 5 minutes from the current time."
-                    }
-                ),
-                400,
-            )
-        else:
-            data["expiration-time"] = expiration_time
-
-    if block_bots:
-        data["block-bots"] = True
-
-    data["creation-date"] = datetime.now().strftime("%Y-%m-%d")
-    data["creation-time"] = datetime.now().strftime("%H:%M:%S")
-
-    data["creation-ip-address"] = get_client_ip()
-
-    insert_url(short_code, data)
+    if existing is None:
+        click_writer.count_links(is_emoji=False)
 
     response = jsonify({"short_url": f"{request.host_url}{short_code}"})
 
@@ -235,15 +178,6 @@ def emoji():
         if not validate_emoji_alias(emojies):
             return jsonify({"EmojiError": "Invalid emoji"}), 400
 
-        if check_if_emoji_alias_exists(emojies):
-            return jsonify({"EmojiError": "Emoji already exists"}), 400
-    else:
-        while True:
-            emojies = generate_emoji_alias()
-
-            if not check_if_emoji_alias_exists(emojies):
-                break
-
     if url and not validate_url(url):
         return (
             jsonify(
@@ -304,7 +238,17 @@ def emoji():
 
     data["creation-ip-address"] = get_client_ip()
 
-    insert_emoji_url(emojies, data)
+    if emojies:
+        # the insert fails on a duplicate key when the alias is taken
+        if not insert_emoji_url(emojies, data):
+            return jsonify({"EmojiError": "Emoji already exists"}), 400
+    else:
+        while True:
+            emojies = generate_emoji_alias()
+
+            if insert_emoji_url(emojies, data):
+                break
+    click_writer.count_links(is_emoji=True)
 
     response = jsonify({"short_url": f"{request.host_url}{emojies}"})
 
@@ -351,17 +295,9 @@ def result(short_code):
 @limiter.exempt
 def redirect_url(short_code):
     user_ip = get_client_ip()
-    projection = {
-        "_id": 1,
-        "url": 1,
-        "password": 1,
-        "max-clicks": 1,
-        "expiration-time": 1,
-        "total-clicks": 1,
-        "ips": {"$elemMatch": {"$eq": user_ip}},
-        "block-bots": 1,
-        "average_redirection_time": 1,
-    }
+    # only the routing fields are needed here, they are served from the
+    # route cache in mongo_utils
+    projection = ROUTE_PROJECTION
 
     short_code = unquote(short_code)
 
@@ -370,11 +306,12 @@ def redirect_url(short_code):
     # Measure redirection time
     start_time = time.perf_counter()
 
-    if validate_emoji_alias(short_code):
-        is_emoji = True
-        url_data = load_emoji_url(short_code, projection)
-    else:
-        url_data = load_url(short_code, projection)
+    with stage_duration.time("redirect_url", "lookup"):
+        if validate_emoji_alias(short_code):
+            is_emoji = True
+            url_data = load_emoji_url(short_code, projection)
+        else:
+            url_data = load_url(short_code, projection)
 
     if not url_data:
         return (
@@ -389,154 +326,114 @@ def redirect_url(short_code):
 
     url = url_data["url"]
 
-    if "max-clicks" in url_data:
-        if int(url_data["total-clicks"]) >= int(url_data["max-clicks"]):
-            return (
-                render_template(
-                    "error.html",
-                    error_code="400",
-                    error_message="SHORT URL EXPIRED",
-                    host_url=request.host_url,
-                ),
-                400,
-            )
-
-    # custom expiration time is currently really buggy and not ready for production
+    with stage_duration.time("redirect_url", "validation"):
+        # custom expiration time is currently really buggy and not ready for production
 
-    if "expiration-time" in url_data:
-        expiration_time = convert_to_gmt(url_data["expiration-time"])
-        if not expiration_time:
-            print("Expiration time is not timezone aware")
-        elif expiration_time <= datetime.now(timezone.utc):
-            return (
-                render_template(
-                    "error.html",
-                    error_code="400",
-                    error_message="SHORT CODE EXPIRED",
-                    host_url=request.host_url,
-                ),
-                400,
-            )
+        if "expiration-time" in url_data:
+            expiration_time = convert_to_gmt(url_data["expiration-time"])
+            if not expiration_time:
+                print("Expiration time is not timezone aware")
+            elif expiration_time <= datetime.now(timezone.utc):
+                return (
+                    render_template(
+                        "error.html",
+                        error_code="400",
+                        error_message="SHORT CODE EXPIRED",
+                        host_url=request.host_url,
+                    ),
+                    400,
+                )
 
-    if "password" in url_data:
-        password = request.values.get("password")
-        if password != url_data["password"]:
-            return (
-                render_template(
-                    "password.html", short_code=short_code, host_url=request.host_url
-                ),
-                401,
-            )
+        if "password" in url_data:
+            password = request.values.get("password")
+            if password != url_data["password"]:
+                return (
+                    render_template(
+                        "password.html",
+                        short_code=short_code,
+                        host_url=request.host_url,
+                    ),
+                    401,
+                )
 
     # store the device and browser information
     user_agent = request.headers.get("User-Agent")
 
-    try:
-        ua = parse(user_agent)
-    except TypeError:
-        return "Invalid User-Agent", 400
+    # bot detection runs inside classify_user_agent on a cache miss, it is
+    # also recorded on its own there
+    with stage_duration.time("redirect_url", "ua_parse"):
+        try:
+            ua = classify_user_agent(user_agent)
+        except TypeError:
+            return "Invalid User-Agent", 400
 
-    os_name = ua.os.family
-    browser = ua.browser.family
+    os_name = ua.os_family
+    browser = ua.browser_family
     referrer = request.headers.get("Referer")
-    country = get_country(user_ip)
-    is_unique_click = url_data.get("ips", None) is None
-
-    if country:
-        country = country.replace(".", " ")
 
-    updates = {"$inc": {}, "$set": {}, "$addToSet": {}}
+    with stage_duration.time("redirect_url", "geo_lookup"):
+        country = get_country(user_ip)
 
-    if "ips" not in url_data:
-        url_data["ips"] = []
+        if country:
+            country = country.replace(".", " ")
 
     if referrer:
-        referrer_raw = tld_no_cache_extract(referrer)
-        referrer = (
-            f"{referrer_raw.domain}.{referrer_raw.suffix}"
-            if referrer_raw.suffix
-            else referrer_raw.domain
-        )
-        sanitized_referrer = re.sub(r"[.$\x00-\x1F\x7F-\x9F]", "_", referrer)
+        referrer = get_referrer_key(referrer)
 
-        updates["$inc"][f"referrer.{sanitized_referrer}.counts"] = 1
-        updates["$addToSet"][f"referrer.{sanitized_referrer}.ips"] = user_ip
-
-    updates["$inc"][f"country.{country}.counts"] = 1
-    updates["$addToSet"][f"country.{country}.ips"] = user_ip
-
-    updates["$inc"][f"browser.{browser}.counts"] = 1
-    updates["$addToSet"][f"browser.{browser}.ips"] = user_ip
+    bot_name = ua.bot
+    if ua.is_crawler and url_data.get("block-bots", False):
+        return (
+            jsonify(
+                {
+                    "error_code": "403",
+                    "error_message": "Access Denied, Bots not allowed",
+                    "host_url": request.host_url,
+                }
+            ),
+            403,
+        )
 
-    updates["$inc"][f"os_name.{os_name}.counts"] = 1
-    updates["$addToSet"][f"os_name.{os_name}.ips"] = user_ip
+    with stage_duration.time("redirect_url", "analytics_write"):
+        # links with a click limit count the click right away, so concurrent
+        # redirects can't go over the limit
+        counted = "max-clicks" in url_data
+        if counted:
+            if is_emoji:
+                reserved = reserve_emoji_url_click(short_code, url_data["max-clicks"])
+            else:
+                reserved = reserve_url_click(short_code, url_data["max-clicks"])
 
-    for bot in BOT_USER_AGENTS:
-        bot_re = re.compile(bot, re.IGNORECASE)
-        if bot_re.search(user_agent):
-            if url_data.get("block-bots", False):
-                return (
-                    jsonify(
-                        {
-                            "error_code": "403",
-                            "error_message": "Access Denied, Bots not allowed",
-                            "host_url": request.host_url,
-                        }
-                    ),
-                    403,
-                )
-            sanitized_bot = re.sub(r"[.$\x00-\x1F\x7F-\x9F]", "_", bot)
-            updates["$inc"][f"bots.{sanitized_bot}"] = 1
-            break
-    else:
-        if crawler_detect.isCrawler(user_agent):
-            if url_data.get("block-bots", False):
+            if not reserved:
                 return (
-                    jsonify(
-                        {
-                            "error_code": "403",
-                            "error_message": "Access Denied, Bots not allowed",
-                            "host_url": request.host_url,
-                        }
+                    render_template(
+                        "error.html",
+                        error_code="400",
+                        error_message="SHORT URL EXPIRED",
+                        host_url=request.host_url,
                     ),
-                    403,
+                    400,
                 )
-            updates["$inc"][f"bots.{crawler_detect.getMatches()}"] = 1
-
-    # increment the counter for the short code
-    today = str(datetime.now()).split()[0]
-    updates["$inc"][f"counter.{today}"] = 1
-
-    if is_unique_click:
-        updates["$inc"][f"unique_counter.{today}"] = 1
 
-    updates["$addToSet"]["ips"] = user_ip
-
-    updates["$inc"]["total-clicks"] = 1
-
-    updates["$set"]["last-click"] = str(
-        datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-    )
-    updates["$set"]["last-click-browser"] = browser
-    updates["$set"]["last-click-os"] = os_name
-    updates["$set"]["last-click-country"] = country
-
-    # Calculate redirection time
-    end_time = time.perf_counter()
-    redirection_time = (end_time - start_time) * 1000
-
-    curr_avg = url_data.get("average_redirection_time", 0)
-
-    # Update Average Redirection Time
-    alpha = 0.1  # Smoothing factor, adjust as needed
-    updates["$set"]["average_redirection_time"] = round(
-        (1 - alpha) * curr_avg + alpha * redirection_time, 2
-    )
-
-    if is_emoji:
-        update_emoji_url(short_code, updates)
-    else:
-        update_url(short_code, updates)
+        # Calculate redirection time
+        end_time = time.perf_counter()
+        redirection_time = (end_time - start_time) * 1000
+
+        # the analytics update is written in the background
+        click_writer.enqueue(
+            ClickEvent(
+                short_code=short_code,
+                is_emoji=is_emoji,
+                ip=user_ip,
+                country=country,
+                browser=browser,
+                os_name=os_name,
+                referrer=referrer,
+                bot=bot_name,
+                redirection_time=redirection_time,
+                counted=counted,
+                clicked_at=datetime.now(timezone.utc),
+            )
+        )
 
     return redirect(url)
 
@@ -581,23 +478,11 @@ def check_password(short_code):
     )
 
 
-METRIC_PIPELINE = [
-    {
-        "$group": {
-            "_id": None,
-            "total-shortlinks": {"$sum": 1},
-            "total-clicks": {"$sum": "$total-clicks"},
-        }
-    }
-]
-
-
 @url_shortener.route("/metric")
 @limiter.exempt
 @cache.cached(timeout=60)
 def metric():
-    result = urls_collection.aggregate(METRIC_PIPELINE).next()
-    del result["_id"]
+    result = load_metric_totals()
     result["total-clicks"] = humanize_number(result["total-clicks"])
     result["total-shortlinks"] = humanize_number(result["total-shortlinks"])
     return jsonify(result)
@@ -0,0 +1,66 @@
+"""
+Compare the stats summaries with the stats pipeline they materialize.
+
+Samples links that have a summary, runs the full stats pipeline for each and
+reports the summaries that differ. Links clicked since the last roll-up are
+expected to differ until the next one; a summary that stays different points
+at a missed roll-up. With --fix the differing summaries are recomputed:
+
+    python check_stats_summaries.py [--limit N] [--fix]
+"""
+
+import argparse
+
+from utils.mongo_utils import (
+    urls_collection,
+    emoji_urls_collection,
+    url_summaries_collection,
+    emoji_summaries_collection,
+    summarize_urls,
+    summarize_emoji_urls,
+)
+from utils.pipeline_utils import get_stats_pipeline
+
+
+def check(collection, summaries_collection, limit=1000):
+    """
+    Return ``(checked, stale)`` with the ids of the summaries that don't
+    match the pipeline in ``stale``. Summaries of deleted links are stale too.
+    """
+    checked = 0
+    stale = []
+    for summary in summaries_collection.aggregate([{"$sample": {"size": limit}}]):
+        checked += 1
+        expected = next(collection.aggregate(get_stats_pipeline(summary["_id"])), None)
+        if expected != summary:
+            stale.append(summary["_id"])
+    return checked, stale
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--limit", type=int, default=1000, help="summaries to check per collection"
+    )
+    parser.add_argument(
+        "--fix", action="store_true", help="recompute the stale summaries"
+    )
+    args = parser.parse_args()
+
+    for collection, summaries_collection, summarize in (
+        (urls_collection, url_summaries_collection, summarize_urls),
+        (emoji_urls_collection, emoji_summaries_collection, summarize_emoji_urls),
+    ):
+        checked, stale = check(collection, summaries_collection, args.limit)
+        print(f"{summaries_collection.name}: {len(stale)} of {checked} stale")
+        for id in stale[:10]:
+            print(f"  {id}")
+
+        if args.fix and stale:
+            # deleted links have nothing to merge, drop their summaries
+            summaries_collection.delete_many({"_id": {"$in": stale}})
+            summarize(stale)
+
+
+if __name__ == "__main__":
+    main()
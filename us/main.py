@@ -12,11 +12,14 @@ from flask_cors import CORS
 from blueprints.api import api
 from blueprints.docs import docs
 from blueprints.limiter import limiter
+from blueprints.metrics import metrics
 from blueprints.seo import seo
 from blueprints.stats import stats
 from blueprints.url_shortener import url_shortener
 from blueprints.cache import cache
 from utils.mongo_utils import client
+from utils.click_utils import click_writer
+from utils.ua_utils import save_ua_snapshot
 
 app = Flask(__name__)
 CORS(app)
@@ -28,6 +31,7 @@ app.register_blueprint(docs)
 app.register_blueprint(seo)
 app.register_blueprint(api)
 app.register_blueprint(stats)
+app.register_blueprint(metrics)
 
 
 @app.errorhandler(404)
@@ -62,6 +66,17 @@ def ratelimit_handler(e):
 
 @atexit.register
 def cleanup():
+    try:
+        click_writer.close()
+        print(f"Click analytics flushed: {click_writer.stats()}")
+    except Exception as e:
+        print(f"Error flushing click analytics: {e}")
+
+    try:
+        save_ua_snapshot()
+    except Exception as e:
+        print(f"Error saving user agent cache: {e}")
+
     try:
         client.close()
         print("MongoDB connection closed successfully")
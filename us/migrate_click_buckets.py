@@ -0,0 +1,119 @@
+"""
+Move the daily counters of existing links into the click-buckets collection.
+
+Every ``counter.<date>`` entry becomes a bucket at local midnight of that date
+with its ``unique_counter`` value (or daily visitor sketch), then the maps are
+removed from the link document. Run it after switching the app to
+CLICK_BUCKETS=true. The counts are set in their own ``migrated_clicks`` and
+``unique`` fields, which are added to the live clicks when read, so the script
+is safe to run again, after --keep-counters or an interrupted run:
+
+    python migrate_click_buckets.py [--dry-run] [--keep-counters] [--batch-size N]
+"""
+
+import argparse
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+from utils.hll_utils import DAILY_VISITORS_SKETCH
+from utils.mongo_utils import (
+    urls_collection,
+    emoji_urls_collection,
+    click_buckets_collection,
+)
+
+COUNTER_FIELDS = ("counter", "unique_counter", DAILY_VISITORS_SKETCH)
+
+
+def build_buckets(url_data, is_emoji):
+    counter = url_data.get("counter") or {}
+    unique_counter = url_data.get("unique_counter") or {}
+    sketches = url_data.get(DAILY_VISITORS_SKETCH) or {}
+
+    operations = []
+    for day in set(counter) | set(unique_counter) | set(sketches):
+        hour = datetime.strptime(day, "%Y-%m-%d").astimezone(timezone.utc)
+        # $set rather than $inc, a rerun writes the same values again
+        updates = {
+            "$set": {
+                "migrated_clicks": counter.get(day, 0),
+                "unique": unique_counter.get(day, 0),
+            }
+        }
+        if sketches.get(day):
+            updates["$max"] = {
+                f"hll.{index}": rank for index, rank in sketches[day].items()
+            }
+        operations.append(
+            UpdateOne(
+                {"link": url_data["_id"], "emoji": is_emoji, "hour": hour},
+                updates,
+                upsert=True,
+            )
+        )
+    return operations
+
+
+def migrate(collection, is_emoji, dry_run=False, keep_counters=False, batch_size=500):
+    query = {"$or": [{field: {"$exists": True}} for field in COUNTER_FIELDS]}
+    projection = {field: 1 for field in COUNTER_FIELDS}
+    migrated = 0
+    buckets = []
+    links = []
+
+    def write():
+        if dry_run:
+            return
+        if buckets:
+            click_buckets_collection.bulk_write(buckets, ordered=False)
+        if links and not keep_counters:
+            # only after their buckets were written
+            collection.bulk_write(links, ordered=False)
+
+    for url_data in collection.find(query, projection):
+        buckets.extend(build_buckets(url_data, is_emoji))
+        links.append(
+            UpdateOne(
+                {"_id": url_data["_id"]},
+                {"$unset": {field: "" for field in COUNTER_FIELDS}},
+            )
+        )
+        if len(links) >= batch_size:
+            write()
+            migrated += len(links)
+            buckets = []
+            links = []
+
+    write()
+    migrated += len(links)
+
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument(
+        "--keep-counters",
+        action="store_true",
+        help="don't remove the counter maps from the links",
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    for collection, is_emoji in (
+        (urls_collection, False),
+        (emoji_urls_collection, True),
+    ):
+        migrated = migrate(
+            collection, is_emoji, args.dry_run, args.keep_counters, args.batch_size
+        )
+        print(
+            f"{collection.name}: {migrated} documents "
+            f"{'would be ' if args.dry_run else ''}migrated"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Convert the visitor ip arrays of existing links into HyperLogLog sketches.
+
+Merges the top-level ``ips`` array into ``visitors_hll`` and every
+``<dim>.<value>.ips`` array into ``<dim>.<value>.hll`` register by register,
+then removes the arrays. The daily
+``unique_counter`` values are kept as they are. Run it after switching the app
+to UNIQUE_COUNTING=sketch:
+
+    python migrate_unique_sketches.py [--dry-run] [--keep-ips] [--batch-size N]
+"""
+
+import argparse
+
+from pymongo import UpdateOne
+
+from utils.hll_utils import VISITORS_SKETCH, hll_add
+from utils.mongo_utils import urls_collection, emoji_urls_collection
+
+DIMENSIONS = ("browser", "os_name", "country", "referrer")
+
+
+def build_migration(url_data, keep_ips=False):
+    # per-register $max merges with the registers clicks already wrote since
+    # the switch to UNIQUE_COUNTING=sketch instead of replacing them
+    updates = {"$max": {}, "$unset": {}}
+
+    sketch = {}
+    for ip in url_data.get("ips", []):
+        hll_add(sketch, ip)
+    for index, rank in sketch.items():
+        updates["$max"][f"{VISITORS_SKETCH}.{index}"] = rank
+    if not keep_ips:
+        updates["$unset"]["ips"] = ""
+
+    for dimension in DIMENSIONS:
+        for value, data in (url_data.get(dimension) or {}).items():
+            if "ips" not in data:
+                continue
+            sketch = {}
+            for ip in data["ips"]:
+                hll_add(sketch, ip)
+            for index, rank in sketch.items():
+                updates["$max"][f"{dimension}.{value}.hll.{index}"] = rank
+            if not keep_ips:
+                updates["$unset"][f"{dimension}.{value}.ips"] = ""
+
+    return {operator: fields for operator, fields in updates.items() if fields}
+
+
+def migrate(collection, dry_run=False, keep_ips=False, batch_size=500):
+    projection = {"ips": 1, **{dimension: 1 for dimension in DIMENSIONS}}
+    migrated = 0
+    operations = []
+
+    for url_data in collection.find({"ips": {"$exists": True}}, projection):
+        updates = build_migration(url_data, keep_ips)
+        if not updates:
+            continue
+        operations.append(UpdateOne({"_id": url_data["_id"]}, updates))
+        if len(operations) >= batch_size:
+            if not dry_run:
+                collection.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+            operations = []
+
+    if operations and not dry_run:
+        collection.bulk_write(operations, ordered=False)
+    migrated += len(operations)
+
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument(
+        "--keep-ips", action="store_true", help="don't remove the ip arrays"
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    for collection in (urls_collection, emoji_urls_collection):
+        migrated = migrate(collection, args.dry_run, args.keep_ips, args.batch_size)
+        print(
+            f"{collection.name}: {migrated} documents "
+            f"{'would be ' if args.dry_run else ''}migrated"
+        )
+
+
+if __name__ == "__main__":
+    main()
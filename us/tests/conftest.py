@@ -0,0 +1,32 @@
+import os
+
+import mongomock
+import pymongo
+import pytest
+from pymongo import InsertOne, UpdateOne
+
+# the app connects to MongoDB when it is imported, give it an in-memory one
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+pymongo.MongoClient = mongomock.MongoClient
+
+
+def _bulk_write(self, requests, ordered=True, **kwargs):
+    # mongomock's bulk_write doesn't work with the operations of pymongo 4.11
+    for request in requests:
+        if isinstance(request, InsertOne):
+            self.insert_one(request._doc)
+        elif isinstance(request, UpdateOne):
+            self.update_one(request._filter, request._doc, upsert=request._upsert)
+        else:
+            raise NotImplementedError(type(request).__name__)
+
+
+mongomock.Collection.bulk_write = _bulk_write
+
+
+@pytest.fixture
+def app():
+    import main
+
+    main.limiter.enabled = False
+    return main.app
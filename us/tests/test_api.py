@@ -0,0 +1,40 @@
+import json
+
+
+def _bulk(client, specs):
+    response = client.post("/api/bulk", json=specs)
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_bulk_and_shorten_share_validation_errors(client):
+    spec = {"url": "https://example.com", "max-clicks": "-3"}
+
+    bulk_error = _bulk(client, [spec])[0]
+    shorten_error = client.post(
+        "/", data=spec, headers={"Accept": "application/json"}
+    ).get_json()
+
+    assert bulk_error == {"index": 0, **shorten_error}
+    assert "MaxClicksError" in shorten_error
+
+
+def test_bulk_reuses_codes_with_dedup_destinations(client, mocker):
+    mocker.patch("utils.link_utils.DEDUP_DESTINATIONS", True)
+    created = client.post(
+        "/",
+        data={"url": "https://example.com/dedup"},
+        headers={"Accept": "application/json"},
+    ).get_json()
+
+    results = _bulk(
+        client,
+        [
+            {"url": "https://example.com/dedup"},
+            {"url": "https://example.com/other"},
+            {"url": "https://example.com/other"},
+        ],
+    )
+
+    assert results[0]["short_url"] == created["short_url"]
+    assert results[1]["short_url"] == results[2]["short_url"]
+    assert results[1]["short_url"] != created["short_url"]
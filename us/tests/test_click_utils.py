@@ -0,0 +1,61 @@
+from datetime import datetime, timezone
+
+import mongomock
+
+from utils.click_utils import ClickAggregator, ClickEvent, build_link_update
+
+
+def _click(short_code, ip="1.1.1.1", country="US"):
+    return ClickEvent(
+        short_code=short_code,
+        is_emoji=False,
+        ip=ip,
+        country=country,
+        browser="Chrome",
+        os_name="Linux",
+        referrer=None,
+        bot=None,
+        redirection_time=10.0,
+        counted=False,
+        clicked_at=datetime.now(timezone.utc),
+    )
+
+
+def test_one_update_per_link_and_flush():
+    aggregator = ClickAggregator()
+    for ip in ("1.1.1.1", "2.2.2.2", "1.1.1.1"):
+        aggregator.add(_click("a", ip))
+    aggregator.add(_click("b"))
+
+    operations = aggregator.pop_operations()
+
+    assert [operation._filter for _, operation in operations] == [
+        {"_id": "a"},
+        {"_id": "b"},
+    ]
+
+
+def test_link_update_applies_the_deltas_to_the_stored_values():
+    collection = mongomock.MongoClient().db.links
+    collection.insert_one(
+        {"_id": "a", "total-clicks": 4, "country": {"US": {"counts": 2}}, "hll": {}}
+    )
+    pending = {
+        "$inc": {"total-clicks": 3, "country.US.counts": 2, "country.DE.counts": 1},
+        "$max": {"hll.5": 2},
+        "$set": {"last-click-os": "$not-a-field-path"},
+        "$addToSet": {},
+        "decay": 1.0,
+        "weighted_sum": 0.0,
+        "visitors": {},
+    }
+    stage = build_link_update("a", pending)._doc[0]["$set"]
+    # mongomock has no $round, the moving average is left out
+    stage.pop("average_redirection_time")
+
+    (link,) = collection.aggregate([{"$addFields": stage}])
+
+    assert link["total-clicks"] == 7
+    assert link["country"] == {"US": {"counts": 4}, "DE": {"counts": 1}}
+    assert link["hll"] == {"5": 2}
+    assert link["last-click-os"] == "$not-a-field-path"
@@ -0,0 +1,8 @@
+def test_cache_gauges_include_evictions_and_expirations(client):
+    body = client.get("/metrics").get_data(as_text=True)
+
+    for field in ("hit_ratio", "evictions", "expirations"):
+        assert f'url_shortener_cache_{field}{{cache="route"}}' in body
+    # the functools caches have no eviction counts
+    assert 'url_shortener_cache_evictions{cache="country"}' not in body
+    assert 'url_shortener_cache_hits{cache="country"}' in body
@@ -0,0 +1,30 @@
+from datetime import datetime
+
+import migrate_click_buckets
+from utils.mongo_utils import (
+    click_buckets_collection,
+    load_click_buckets,
+    urls_collection,
+)
+
+
+def test_migration_can_run_again():
+    day = datetime.now().strftime("%Y-%m-%d")
+    urls_collection.insert_one(
+        {
+            "_id": "migrated",
+            "url": "https://example.com",
+            "counter": {day: 3},
+            "unique_counter": {day: 2},
+        }
+    )
+
+    migrate_click_buckets.migrate(urls_collection, False, keep_counters=True)
+    migrate_click_buckets.migrate(urls_collection, False)
+    migrate_click_buckets.migrate(urls_collection, False)
+
+    hour = datetime.strptime(day, "%Y-%m-%d").astimezone()
+    buckets = load_click_buckets("migrated", False, hour)
+    assert [(b["migrated_clicks"], b["unique"]) for b in buckets] == [(3, 2)]
+    assert "counter" not in urls_collection.find_one({"_id": "migrated"})
+    click_buckets_collection.delete_many({"link": "migrated"})
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from utils import mongo_utils
+
+THREADS = 8
+
+
+def _wait_for_followers(shared_before):
+    # hold the query until every other thread is waiting on it
+    deadline = time.monotonic() + 5
+    while mongo_utils.single_flight.shared - shared_before < THREADS - 1:
+        assert time.monotonic() < deadline, "the callers didn't share the query"
+        time.sleep(0.001)
+
+
+def _run_concurrently(call):
+    results = [None] * THREADS
+    barrier = threading.Barrier(THREADS)
+
+    def worker(index):
+        barrier.wait()
+        results[index] = call()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.mark.parametrize(
+    "load, collection",
+    [
+        (mongo_utils.load_url, mongo_utils.urls_collection),
+        (mongo_utils.load_emoji_url, mongo_utils.emoji_urls_collection),
+    ],
+)
+def test_concurrent_route_lookups_share_one_query(mocker, load, collection):
+    code = f"shared-{collection.name}"
+    mongo_utils.invalidate_route(collection, code)
+    shared_before = mongo_utils.single_flight.shared
+
+    def find_one(query, projection=None):
+        _wait_for_followers(shared_before)
+        return {"_id": query["_id"], "url": "https://example.com"}
+
+    find_one = mocker.patch.object(collection, "find_one", side_effect=find_one)
+
+    results = _run_concurrently(lambda: load(code, mongo_utils.ROUTE_PROJECTION))
+
+    assert find_one.call_count == 1
+    assert results == [{"_id": code, "url": "https://example.com"}] * THREADS
+
+
+def test_concurrent_aggregations_share_one_query(mocker):
+    collection = mongo_utils.urls_collection
+    shared_before = mongo_utils.single_flight.shared
+
+    def aggregate(pipeline):
+        _wait_for_followers(shared_before)
+        return iter([{"_id": "shared", "counter": {"2024-01-01": 1}}])
+
+    aggregate = mocker.patch.object(collection, "aggregate", side_effect=aggregate)
+
+    pipeline = [{"$match": {"_id": "shared"}}]
+    results = _run_concurrently(lambda: mongo_utils.aggregate_url(pipeline))
+
+    assert aggregate.call_count == 1
+    assert results == [{"_id": "shared", "counter": {"2024-01-01": 1}}] * THREADS
+    # every caller gets its own copy to modify
+    assert len({id(result["counter"]) for result in results}) == THREADS
@@ -0,0 +1,25 @@
+from utils.url_utils import get_referrer_key
+
+
+def test_referrer_key_is_the_registered_domain():
+    assert get_referrer_key("https://www.google.co.uk/search?q=x") == "google_co_uk"
+    assert get_referrer_key("news.ycombinator.com/item") == "ycombinator_com"
+
+
+def test_referrer_key_of_a_malformed_referrer():
+    assert get_referrer_key("http://[bad") is None
+
+
+def test_redirect_with_a_malformed_referrer(client):
+    response = client.post(
+        "/",
+        data={"url": "https://example.com"},
+        headers={"Accept": "application/json"},
+    )
+    short_code = response.json["short_url"].rsplit("/", 1)[1]
+
+    response = client.get(
+        f"/{short_code}",
+        headers={"Referer": "http://[bad", "User-Agent": "Mozilla/5.0"},
+    )
+    assert response.status_code == 302
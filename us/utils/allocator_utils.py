@@ -0,0 +1,117 @@
+import hashlib
+import os
+import string
+import threading
+
+BASE62_ALPHABET = string.ascii_lowercase + string.ascii_uppercase + string.digits
+FEISTEL_ROUNDS = 4
+
+
+def encode_base62(number, length):
+    chars = []
+    for _ in range(length):
+        number, digit = divmod(number, 62)
+        chars.append(BASE62_ALPHABET[digit])
+    return "".join(reversed(chars))
+
+
+class KeyedPermutation:
+    """
+    Keyed bijection of ``[0, size)`` onto itself: a balanced Feistel network
+    over the smallest even number of bits covering ``size``, cycle walking
+    until the output falls back into the range.
+    """
+
+    def __init__(self, key, size):
+        self.key = key
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+
+    def _round(self, index, value):
+        digest = hashlib.blake2b(
+            value.to_bytes(8, "big") + bytes([index]), key=self.key, digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big") & self.mask
+
+    def _feistel(self, value):
+        left, right = value >> self.half, value & self.mask
+        for index in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ self._round(index, right)
+        return (left << self.half) | right
+
+    def __call__(self, value):
+        value = self._feistel(value)
+        while value >= self.size:
+            value = self._feistel(value)
+        return value
+
+
+class ShortCodeAllocator:
+    """
+    Hands out unique, non-sequential short codes without checking the
+    database first.
+
+    Every code comes from a per-length counter: ``lease(length, count)``
+    atomically reserves ``count`` values from the shared counter of that
+    length and returns the first one, so each process only goes to the
+    database once per block. The counter value is encoded through a keyed
+    permutation of the ``62 ** length`` codes of that length. Once a
+    counter passes ``max_fill`` of its codes, allocation moves on to the
+    next length.
+
+    The permutation key comes from ``load_key()``, on first use. Codes can
+    still collide with custom aliases or links created before the allocator,
+    callers insert and allocate again on a duplicate key.
+    """
+
+    def __init__(self, lease, load_key, min_length=6, block_size=100, max_fill=0.9):
+        self.lease = lease
+        self.load_key = load_key
+        self.key = None
+        self.block_size = block_size
+        self.max_fill = max_fill
+        self._min_length = min_length
+        self._permutations = {}
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # a leased block must not be shared with a forked process
+        self._pid = os.getpid()
+        self.length = self._min_length
+        self._next = 0
+        self._end = 0
+
+    def _permutation(self, length):
+        permutation = self._permutations.get(length)
+        if permutation is None:
+            permutation = self._permutations[length] = KeyedPermutation(
+                self.key, 62**length
+            )
+        return permutation
+
+    def _lease_block(self):
+        while True:
+            limit = int(62**self.length * self.max_fill)
+            start = self.lease(self.length, self.block_size)
+            if start < limit:
+                self._next = start
+                self._end = min(start + self.block_size, limit)
+                return
+            self.length += 1
+
+    def allocate(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if self.key is None:
+                self.key = self.load_key()
+            if self._next >= self._end:
+                self._lease_block()
+            value = self._next
+            self._next += 1
+            length = self.length
+
+        return encode_base62(self._permutation(length)(value), length)
@@ -1,6 +1,17 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import functools
+import numpy as np
 import pycountry
+from utils.hll_utils import hll_estimate, hll_merge
+
+# windows the stats routes accept, in days, and the keys of their series
+STATS_WINDOWS = (7, 30, 90)
+SERIES_KEY_FORMATS = {
+    "hour": "%Y-%m-%d %H:00",
+    "day": "%Y-%m-%d",
+    "week": "%Y-%m-%d",
+    "month": "%Y-%m",
+}
 
 
 def convert_country_data(data):
@@ -19,37 +30,123 @@ def convert_country_name(country_name: str) -> str:
         return "XX"
 
 
-def add_missing_dates(key, url_data):
-    counter = url_data[key]
-
-    # Get the current date
-
-    # Get the first and last click dates
-    first_click_date = url_data["creation-date"]  # next(iter(counter.keys()))
-    last_click_date = datetime.now().strftime("%Y-%m-%d")
-
-    # Convert the click dates to datetime objects
-    first_date = datetime.strptime(first_click_date, "%Y-%m-%d")
-    last_date = datetime.strptime(last_click_date, "%Y-%m-%d")
-
-    # Generate a list of dates between the first and last click dates
-    date_range = [
-        first_date + timedelta(days=x) for x in range((last_date - first_date).days + 1)
-    ]
-    all_dates = [date.strftime("%Y-%m-%d") for date in date_range]
-
-    # Add missing dates with a counter value of 0
-    for date in all_dates:
-        if date not in counter:
-            counter[date] = 0
-
-    # Sort the counter dictionary by dates
-    sorted_counter = {date: counter[date] for date in sorted(counter.keys())}
-
-    # Update the url_data with the modified counter
-    url_data[key] = sorted_counter
-
-    return url_data
+def _parse_series_keys(keys, unit):
+    keys = np.asarray(keys, dtype=str)
+    if unit == "h":
+        # "YYYY-MM-DD HH:00" keys parse as ISO datetimes once the space is a "T"
+        keys = np.char.replace(keys, " ", "T")
+    return keys.astype(f"datetime64[{unit}]")
+
+
+def _resample(dates, resolution):
+    if resolution == "week":
+        days = dates.astype("datetime64[D]")
+        # day 0 of datetime64 is a Thursday, weeks start on Monday
+        return days - (days.astype(np.int64) + 3) % 7
+    if resolution == "month":
+        return dates.astype("datetime64[M]")
+    return dates
+
+
+def _format_series_labels(labels, resolution):
+    if resolution == "hour":
+        return [
+            f"{label.replace('T', ' ')}:00"
+            for label in np.datetime_as_string(labels, unit="h")
+        ]
+    unit = "M" if resolution == "month" else "D"
+    return np.datetime_as_string(labels, unit=unit).tolist()
+
+
+def build_dense_series(counters, start, end, resolution="day"):
+    """
+    Add up date keyed ``counters`` per day, week, month or hour from ``start``
+    to ``end`` (series keys, inclusive), with a zero for every period without
+    clicks. Keys can be days, hours or period labels; weeks are labelled by
+    their Monday and months as YYYY-MM. All counters share one range and are
+    returned in order, empty when ``end`` is before ``start``.
+    """
+    unit = "h" if resolution == "hour" else "D"
+    start, end = _parse_series_keys([start, end], unit)
+    if end < start:
+        return [{} for _ in counters]
+    labels = _resample(np.arange(start, end + 1), resolution)
+    if resolution in ("week", "month"):
+        # the range is sorted, keep the first slot of every period
+        labels = labels[np.concatenate(([True], labels[1:] != labels[:-1]))]
+    keys = _format_series_labels(labels, resolution)
+
+    series = []
+    for counter in counters:
+        totals = np.zeros(len(labels), dtype=np.int64)
+        if counter:
+            periods = _resample(_parse_series_keys(list(counter), unit), resolution)
+            counts = np.fromiter(counter.values(), dtype=np.int64, count=len(counter))
+            positions = np.searchsorted(labels, periods)
+            inside = positions < len(labels)
+            inside[inside] = labels[positions[inside]] == periods[inside]
+            np.add.at(totals, positions[inside], counts[inside])
+        series.append(dict(zip(keys, totals.tolist())))
+    return series
+
+
+def series_key(moment, resolution):
+    if resolution == "week":
+        moment -= timedelta(days=moment.weekday())
+    return moment.strftime(SERIES_KEY_FORMATS[resolution])
+
+
+def get_window_start(days, granularity, now=None):
+    """
+    Return the first UTC hour of a window of ``days`` days ending now, days
+    start at local midnight like the daily counters.
+    """
+    now = (now or datetime.now(timezone.utc)).astimezone()
+    if granularity == "hour":
+        start = now - timedelta(hours=days * 24 - 1)
+    else:
+        start = now - timedelta(days=days - 1)
+        start = start.replace(hour=0)
+    return start.replace(minute=0, second=0, microsecond=0).astimezone(timezone.utc)
+
+
+def build_click_series(buckets, start, granularity, now=None):
+    """
+    Turn hourly click buckets into dense ``counter`` and ``unique_counter``
+    series from ``start`` to now. Unique visitors of a period are estimated
+    from the merged sketches of its hours.
+    """
+    counter = {}
+    unique_counter = {}
+    sketches = {}
+    for bucket in buckets:
+        hour = bucket["hour"]
+        if hour.tzinfo is None:
+            hour = hour.replace(tzinfo=timezone.utc)
+        key = series_key(hour.astimezone(), granularity)
+        # buckets migrated from the counter maps keep their counts apart from
+        # the clicks since, with an exact unique count instead of a sketch
+        counter[key] = (
+            counter.get(key, 0)
+            + bucket.get("clicks", 0)
+            + bucket.get("migrated_clicks", 0)
+        )
+        unique_counter[key] = unique_counter.get(key, 0) + bucket.get("unique", 0)
+        if bucket.get("hll"):
+            sketches[key] = hll_merge(sketches.get(key), bucket["hll"])
+
+    for key, sketch in sketches.items():
+        unique_counter[key] += hll_estimate(sketch)
+
+    # the range is cut in hours or days, weeks and months are labelled later
+    unit = "hour" if granularity == "hour" else "day"
+    now = (now or datetime.now(timezone.utc)).astimezone()
+    return build_dense_series(
+        [counter, unique_counter],
+        series_key(start.astimezone(), unit),
+        series_key(now, unit),
+        granularity,
+    )
 
 
 def top_four(dictionary):
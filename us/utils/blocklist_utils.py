@@ -0,0 +1,73 @@
+import re
+from urllib.parse import urlsplit
+from utils.url_utils import get_registered_domain
+
+# entries that are just a host name, e.g. "example.com" or "example\.com"
+DOMAIN_ENTRY = re.compile(
+    r"(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\\?\.)+[a-z][a-z0-9-]*[a-z0-9]", re.IGNORECASE
+)
+
+
+class BlockedUrlMatcher:
+    """
+    Matches urls against the entries of the blocked-urls collection.
+
+    Entries that are a plain host name block that host and its subdomains and
+    are kept in a dict keyed on the registered domain. Every other entry is a
+    regex matched at the start of the url, like ``re.match``; they are combined
+    into one alternation so a url is scanned once.
+    """
+
+    def __init__(self, entries):
+        self.domains = {}
+        self.patterns = []
+        # patterns with groups can't share an alternation (back references
+        # would point to the wrong group), they are matched one by one
+        self.separate = []
+        self.invalid = []
+
+        for entry in entries:
+            if DOMAIN_ENTRY.fullmatch(entry):
+                host = entry.replace("\\.", ".").lower()
+                self.domains.setdefault(get_registered_domain(host), set()).add(host)
+                continue
+            try:
+                compiled = re.compile(entry)
+            except re.error:
+                self.invalid.append(entry)
+                continue
+            if compiled.groups:
+                self.separate.append(compiled)
+            else:
+                self.patterns.append(entry)
+
+        self.combined = None
+        if self.patterns:
+            try:
+                self.combined = re.compile(
+                    "|".join(f"(?:{pattern})" for pattern in self.patterns)
+                )
+            except re.error:
+                # e.g. inline flags, which are only allowed at the start
+                self.separate.extend(re.compile(pattern) for pattern in self.patterns)
+                self.patterns = []
+
+    def is_blocked(self, url):
+        if self.domains:
+            host = urlsplit(url).hostname
+            hosts = self.domains.get(get_registered_domain(host)) if host else None
+            if hosts and any(
+                host == blocked or host.endswith(f".{blocked}") for blocked in hosts
+            ):
+                return True
+
+        if self.combined is not None and self.combined.match(url):
+            return True
+        return any(pattern.match(url) for pattern in self.separate)
+
+    def __len__(self):
+        return (
+            sum(len(hosts) for hosts in self.domains.values())
+            + len(self.patterns)
+            + len(self.separate)
+        )
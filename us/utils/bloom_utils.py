@@ -0,0 +1,171 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from utils.cache_utils import BackgroundWorker
+
+
+class BloomFilter:
+    """
+    Bloom filter sized for ``capacity`` keys at a false-positive rate of
+    ``error_rate``. Membership tests can return false positives, never false
+    negatives.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing: k positions from two 64 bit hashes
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    def false_positive_rate(self):
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class ShortCodeFilter(BackgroundWorker):
+    """
+    Per-process Bloom filter of every existing short code, used to answer
+    lookups of codes that don't exist without a database query.
+
+    ``scan(since)`` yields the keys of links created at or after ``since``
+    (every link when ``since`` is None). The filter is built in a background
+    thread on first use and picks up links created by other processes every
+    ``refresh_interval`` seconds; until the first build finishes every key is
+    reported as possibly existing. A key missing from the filter is reported
+    missing without a query, so a link created by another process can be
+    reported missing here for up to ``refresh_interval`` seconds.
+
+    ``watch(add, since)``, when given, closes that window: it adds the keys of
+    links created since ``since`` and then every inserted key as it arrives,
+    e.g. from a change stream. When it returns or fails the filter goes back
+    to refreshing every ``refresh_interval`` seconds and tries again.
+    """
+
+    # margin for clock differences between app servers
+    CLOCK_SKEW = timedelta(seconds=60)
+    worker_name = "short-code-filter"
+
+    def __init__(self, scan, capacity, error_rate, refresh_interval, watch=None):
+        self.scan = scan
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.watch = watch
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._reset_worker()
+        self._filter = None
+        self._building = False
+        self._added_while_building = []
+        self.lookups = 0
+        # lookups answered without a query
+        self.saved_queries = 0
+
+    def _build(self):
+        with self._lock:
+            self._building = True
+        started_at = datetime.now(timezone.utc)
+        keys = list(self.scan(None))
+        bloom = BloomFilter(max(self.capacity, len(keys) * 2), self.error_rate)
+        for key in keys:
+            bloom.add(key)
+
+        with self._lock:
+            for key in self._added_while_building:
+                if key not in bloom:
+                    bloom.add(key)
+            self._added_while_building = []
+            self._building = False
+            self._filter = bloom
+        return started_at
+
+    def _run(self):
+        synced_at = None
+        while True:
+            try:
+                if synced_at is None or self._filter.count > self._filter.capacity:
+                    synced_at = self._build()
+                else:
+                    started_at = datetime.now(timezone.utc)
+                    keys = list(self.scan(synced_at - self.CLOCK_SKEW))
+                    with self._lock:
+                        # the scans overlap by CLOCK_SKEW, don't count keys twice
+                        for key in keys:
+                            if key not in self._filter:
+                                self._filter.add(key)
+                    synced_at = started_at
+            except Exception as e:
+                print(f"Error refreshing the short code filter: {e}")
+
+            if self.watch is not None and synced_at is not None:
+                try:
+                    self.watch(self._add_watched, synced_at - self.CLOCK_SKEW)
+                except Exception as e:
+                    print(f"Error watching the new short codes: {e}")
+            time.sleep(self.refresh_interval)
+
+    def _add_watched(self, key):
+        """
+        Add a key from ``watch``, returns False once the filter is full and
+        has to be rebuilt, which ends the watch.
+        """
+        self.add(key)
+        return self._filter.count <= self._filter.capacity
+
+    def add(self, key):
+        with self._lock:
+            # keys added during a (re)build are replayed into the new filter
+            if self._building:
+                self._added_while_building.append(key)
+            if self._filter is not None and key not in self._filter:
+                self._filter.add(key)
+
+    def might_exist(self, key):
+        self._ensure_worker()
+        self.lookups += 1
+        bloom = self._filter
+        if bloom is None or key in bloom:
+            return True
+        self.saved_queries += 1
+        return False
+
+    def stats(self):
+        bloom = self._filter
+        if bloom is None:
+            return {"ready": False, "lookups": self.lookups}
+        return {
+            "ready": True,
+            "lookups": self.lookups,
+            "saved_queries": self.saved_queries,
+            "keys": bloom.count,
+            "capacity": bloom.capacity,
+            "size_bytes": len(bloom._bits),
+            "hashes": bloom.hashes,
+            "target_error_rate": bloom.error_rate,
+            "estimated_error_rate": round(bloom.false_positive_rate(), 6),
+        }
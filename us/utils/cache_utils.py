@@ -0,0 +1,261 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU cache with an optional time-to-live (in
+    seconds) for every entry.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        """
+        Return the live entries, least recently used first.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, value)
+                for key, (value, expires_at) in self._data.items()
+                if expires_at is None or expires_at > now
+            ]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: the first caller runs
+    the function, callers arriving while it is in flight wait for it and get
+    the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Return ``(result, shared)`` where ``shared`` tells whether the result
+        came from a call made by another thread.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        return {"calls": self.calls, "shared": self.shared}
+
+
+class BackgroundWorker:
+    """
+    Base of the per-process objects that work in a daemon thread of their own.
+    Subclasses name the thread with ``worker_name``, implement ``_run``, create
+    ``self._lock`` and have a ``_reset`` that calls ``_reset_worker``.
+
+    ``_ensure_worker`` resets the object in a forked child, where the thread
+    doesn't exist, e.g. gunicorn --preload, and starts the thread if it isn't
+    running, again if it died.
+    """
+
+    worker_name = "background-worker"
+
+    def _reset_worker(self):
+        self._pid = os.getpid()
+        self._thread = None
+        self.restarts = 0
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    if self._thread is not None:
+                        self.restarts += 1
+                    self._thread = threading.Thread(
+                        target=self._run, name=self.worker_name, daemon=True
+                    )
+                    self._thread.start()
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class VersionedCache(BackgroundWorker):
+    """
+    Keeps the value returned by ``load()`` and loads it again when
+    ``load_version()`` returns a different version stamp, checked at most
+    every ``check_interval`` seconds, or once it is ``max_age`` seconds old.
+    Other threads keep getting the previous value while it is reloaded.
+
+    ``watch(callback)``, when given, runs in a daemon thread and calls
+    ``callback`` whenever the data changes, e.g. from a change stream, so
+    changes are picked up on the next request.
+    """
+
+    def __init__(self, name, load, load_version, check_interval, max_age, watch=None):
+        self.name = name
+        self.load = load
+        self.load_version = load_version
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.watch = watch
+        self.worker_name = f"{name}-watcher"
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._reset_worker()
+        self.value = None
+        self._version = None
+        self._built_at = None
+        self._checked_at = None
+        self.rebuilds = 0
+
+    def _run(self):
+        self.watch(self.invalidate)
+
+    def invalidate(self):
+        self._checked_at = None
+        self._built_at = None
+
+    def get(self):
+        if self.watch is not None:
+            self._ensure_worker()
+        now = time.monotonic()
+        if (
+            self.value is not None
+            and self._checked_at is not None
+            and now - self._checked_at < self.check_interval
+        ):
+            return self.value
+
+        if not self._lock.acquire(blocking=self.value is None):
+            return self.value
+        try:
+            if (
+                self._checked_at is not None
+                and now - self._checked_at < self.check_interval
+            ):
+                # another thread checked while this one was waiting
+                return self.value
+            version = self.load_version()
+            if (
+                self._built_at is None
+                or now - self._built_at >= self.max_age
+                or version != self._version
+            ):
+                self.value = self.load()
+                self._version = version
+                self._built_at = now
+                self.rebuilds += 1
+            self._checked_at = now
+        except Exception as e:
+            if self.value is None:
+                raise
+            print(f"Error refreshing the {self.name}: {e}")
+            self._checked_at = now
+        finally:
+            self._lock.release()
+        return self.value
+
+    def stats(self):
+        return {"version": self._version, "rebuilds": self.rebuilds}
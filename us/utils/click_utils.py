@@ -0,0 +1,515 @@
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+from utils.cache_utils import BackgroundWorker
+from utils.mongo_utils import (
+    CLICK_BUCKETS,
+    bulk_update_urls,
+    bulk_update_emoji_urls,
+    bulk_update_click_buckets,
+    increment_global_counters,
+)
+from utils.summary_utils import stats_rollup
+from utils.hll_utils import (
+    SKETCH_MODE,
+    VISITORS_SKETCH,
+    DAILY_VISITORS_SKETCH,
+    hll_register,
+)
+
+CLICK_QUEUE_SIZE = int(os.environ.get("CLICK_QUEUE_SIZE", 10000))
+# what happens when the queue is full:
+#   drop  - discard the new click right away
+#   block - wait up to CLICK_QUEUE_BLOCK_TIMEOUT seconds for room, then discard
+#   sync  - skip the queue and write the click from the request thread
+CLICK_QUEUE_POLICY = os.environ.get("CLICK_QUEUE_POLICY", "drop")
+CLICK_QUEUE_BLOCK_TIMEOUT = float(os.environ.get("CLICK_QUEUE_BLOCK_TIMEOUT", 0.05))
+# smoothing factor of the average_redirection_time moving average
+REDIRECTION_TIME_ALPHA = 0.1
+# pending clicks are merged per link and written every CLICK_FLUSH_INTERVAL_MS
+# milliseconds or as soon as CLICK_FLUSH_MAX_EVENTS clicks are waiting
+CLICK_FLUSH_INTERVAL_MS = int(os.environ.get("CLICK_FLUSH_INTERVAL_MS", 1000))
+CLICK_FLUSH_MAX_EVENTS = int(os.environ.get("CLICK_FLUSH_MAX_EVENTS", 1000))
+
+ClickEvent = namedtuple(
+    "ClickEvent",
+    [
+        "short_code",
+        "is_emoji",
+        "ip",
+        "country",
+        "browser",
+        "os_name",
+        "referrer",
+        "bot",
+        "redirection_time",
+        # total-clicks was already incremented when the click was reserved
+        "counted",
+        "clicked_at",
+    ],
+)
+
+# links created by this process, counted in the global totals with the clicks
+LinkCount = namedtuple("LinkCount", ["is_emoji", "count"])
+
+
+def build_click_updates(event):
+    updates = {"$inc": {}, "$set": {}, "$addToSet": {}, "$max": {}}
+    day = click_day(event)
+
+    if SKETCH_MODE:
+        index, rank = hll_register(event.ip)
+
+        def count_visitor(field):
+            updates["$max"][f"{field}.hll.{index}"] = rank
+
+        updates["$max"][f"{VISITORS_SKETCH}.{index}"] = rank
+        if not CLICK_BUCKETS:
+            updates["$max"][f"{DAILY_VISITORS_SKETCH}.{day}.{index}"] = rank
+    else:
+
+        def count_visitor(field):
+            updates["$addToSet"][f"{field}.ips"] = event.ip
+
+    if event.referrer:
+        updates["$inc"][f"referrer.{event.referrer}.counts"] = 1
+        count_visitor(f"referrer.{event.referrer}")
+
+    updates["$inc"][f"country.{event.country}.counts"] = 1
+    count_visitor(f"country.{event.country}")
+
+    updates["$inc"][f"browser.{event.browser}.counts"] = 1
+    count_visitor(f"browser.{event.browser}")
+
+    updates["$inc"][f"os_name.{event.os_name}.counts"] = 1
+    count_visitor(f"os_name.{event.os_name}")
+
+    if event.bot:
+        updates["$inc"][f"bots.{event.bot}"] = 1
+
+    if not CLICK_BUCKETS:
+        updates["$inc"][f"counter.{day}"] = 1
+
+    if not event.counted:
+        updates["$inc"]["total-clicks"] = 1
+
+    updates["$set"]["last-click"] = event.clicked_at.strftime("%Y-%m-%d %H:%M:%S")
+    updates["$set"]["last-click-browser"] = event.browser
+    updates["$set"]["last-click-os"] = event.os_name
+    updates["$set"]["last-click-country"] = event.country
+
+    return updates
+
+
+def click_day(event):
+    # daily counters use the server's local date
+    return event.clicked_at.astimezone().strftime("%Y-%m-%d")
+
+
+def click_hour(event):
+    # buckets are keyed by the UTC hour, days are cut in local time when read
+    return event.clicked_at.astimezone(timezone.utc).replace(
+        minute=0, second=0, microsecond=0
+    )
+
+
+def build_bucket_update(short_code, is_emoji, hour, clicks, sketch):
+    updates = {"$inc": {"clicks": clicks}}
+    if sketch:
+        updates["$max"] = {f"hll.{index}": rank for index, rank in sketch.items()}
+    return UpdateOne(
+        {"link": short_code, "emoji": is_emoji, "hour": hour}, updates, upsert=True
+    )
+
+
+def build_link_update(short_code, pending):
+    """
+    Turn the merged updates of a link into one pipeline update. A single
+    ``$set`` stage evaluates every expression against the stored document:
+    ``$inc`` adds to the stored value, ``$max`` keeps the higher one,
+    ``$addToSet`` appends the values not stored yet and ``$set`` overwrites.
+
+    Several samples are applied to the average_redirection_time moving average
+    at once: after n samples the stored average is multiplied by (1 - alpha)^n
+    (``decay``) and the weighted samples are added. The new ``visitors`` (ip to
+    day) are appended to the top-level ``ips`` array and, unless CLICK_BUCKETS
+    is set, the IPs the link hasn't seen yet are added to ``unique_counter``.
+    """
+    fields = {}
+    for field, value in pending["$inc"].items():
+        fields[field] = {"$add": [{"$ifNull": [f"${field}", 0]}, value]}
+    for field, value in pending["$max"].items():
+        fields[field] = {"$max": [f"${field}", value]}
+    for field, value in pending["$set"].items():
+        fields[field] = {"$literal": value}
+    for field, values in pending["$addToSet"].items():
+        fields[field] = _append_new(field, list(values))
+
+    average = {"$ifNull": ["$average_redirection_time", 0]}
+    decay, weighted_sum = pending["decay"], pending["weighted_sum"]
+    fields["average_redirection_time"] = {
+        "$round": [{"$add": [{"$multiply": [decay, average]}, weighted_sum]}, 2]
+    }
+
+    visitors = pending["visitors"]
+    if visitors:
+        if not CLICK_BUCKETS:
+            days = {}
+            for ip, day in visitors.items():
+                days.setdefault(day, []).append(ip)
+            for day, day_ips in days.items():
+                new_ips = {
+                    "$setDifference": [{"$literal": day_ips}, {"$ifNull": ["$ips", []]}]
+                }
+                fields[f"unique_counter.{day}"] = {
+                    "$add": [
+                        {"$ifNull": [f"$unique_counter.{day}", 0]},
+                        {"$size": new_ips},
+                    ]
+                }
+        fields["ips"] = _append_new("ips", list(visitors))
+
+    return UpdateOne({"_id": short_code}, [{"$set": fields}])
+
+
+def _append_new(field, values):
+    # $addToSet with $each: the stored array followed by the values it lacks
+    stored = {"$ifNull": [f"${field}", []]}
+    return {
+        "$concatArrays": [
+            stored,
+            {"$setDifference": [{"$literal": values}, stored]},
+        ]
+    }
+
+
+class ClickAggregator:
+    """
+    Merges the updates of pending clicks so each link gets a single update per
+    flush: ``$inc`` deltas are summed, ``$addToSet`` values are unioned, the
+    highest ``$max`` values and the most recent ``$set`` values win. They are
+    written with the moving average and the new visitors in one pipeline
+    update (see build_link_update). With CLICK_BUCKETS the
+    clicks and visitor sketch of every link and hour are merged the same way.
+    LinkCount events only add to the created ``links``.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._buckets = {}
+        self.events = 0
+        self.clicks = {"urls": 0, "emojis": 0}
+        self.links = {"urls": 0, "emojis": 0}
+        self.oldest_click = None
+
+    def add(self, event):
+        if isinstance(event, LinkCount):
+            self.links["emojis" if event.is_emoji else "urls"] += event.count
+            return
+
+        updates = build_click_updates(event)
+        key = (event.is_emoji, event.short_code)
+        pending = self._pending.get(key)
+
+        if pending is None:
+            self._pending[key] = {
+                "$inc": updates["$inc"],
+                "$addToSet": {
+                    field: {value} for field, value in updates["$addToSet"].items()
+                },
+                "$set": updates["$set"],
+                "$max": updates["$max"],
+                "visitors": {},
+                "decay": 1.0,
+                "weighted_sum": 0.0,
+            }
+            pending = self._pending[key]
+        else:
+            for field, value in updates["$inc"].items():
+                pending["$inc"][field] = pending["$inc"].get(field, 0) + value
+            for field, value in updates["$addToSet"].items():
+                pending["$addToSet"].setdefault(field, set()).add(value)
+            pending["$set"].update(updates["$set"])
+            for field, value in updates["$max"].items():
+                if pending["$max"].get(field, 0) < value:
+                    pending["$max"][field] = value
+
+        if not SKETCH_MODE:
+            pending["visitors"].setdefault(event.ip, click_day(event))
+        pending["decay"] *= 1 - REDIRECTION_TIME_ALPHA
+        pending["weighted_sum"] = (1 - REDIRECTION_TIME_ALPHA) * pending[
+            "weighted_sum"
+        ] + REDIRECTION_TIME_ALPHA * event.redirection_time
+
+        if CLICK_BUCKETS:
+            bucket_key = (event.is_emoji, event.short_code, click_hour(event))
+            bucket = self._buckets.setdefault(bucket_key, {"clicks": 0, "hll": {}})
+            bucket["clicks"] += 1
+            index, rank = hll_register(event.ip)
+            if bucket["hll"].get(index, 0) < rank:
+                bucket["hll"][index] = rank
+
+        self.events += 1
+        self.clicks["emojis" if event.is_emoji else "urls"] += 1
+        if self.oldest_click is None or event.clicked_at < self.oldest_click:
+            self.oldest_click = event.clicked_at
+
+    def __len__(self):
+        return len(self._pending)
+
+    def keys(self):
+        """Return the pending links as ``(is_emoji, short_code)`` pairs."""
+        return list(self._pending)
+
+    def pop_bucket_operations(self):
+        """
+        Return the upserts of the pending click buckets, they are cleared by
+        pop_operations too.
+        """
+        operations = [
+            build_bucket_update(
+                short_code, is_emoji, hour, bucket["clicks"], bucket["hll"]
+            )
+            for (is_emoji, short_code, hour), bucket in self._buckets.items()
+        ]
+        self._buckets = {}
+        return operations
+
+    def pop_operations(self):
+        """
+        Return the bulk operations for every pending link as ``(is_emoji,
+        operation)`` pairs and start over with an empty aggregator.
+        """
+        operations = []
+        for (is_emoji, short_code), pending in self._pending.items():
+            operations.append((is_emoji, build_link_update(short_code, pending)))
+
+        self._pending = {}
+        self._buckets = {}
+        self.events = 0
+        self.clicks = {"urls": 0, "emojis": 0}
+        self.links = {"urls": 0, "emojis": 0}
+        self.oldest_click = None
+        return operations
+
+
+class ClickWriter(BackgroundWorker):
+    """
+    Write-behind queue for click analytics. Redirects enqueue a ClickEvent and
+    return, a daemon thread drains the queue into a ClickAggregator and applies
+    the merged updates with ``bulk_write``. The created links and clicks are
+    added to the global counters with one increment per flush.
+    """
+
+    _STOP = object()
+    worker_name = "click-writer"
+
+    def __init__(
+        self,
+        maxsize=CLICK_QUEUE_SIZE,
+        policy=CLICK_QUEUE_POLICY,
+        block_timeout=CLICK_QUEUE_BLOCK_TIMEOUT,
+        flush_interval_ms=CLICK_FLUSH_INTERVAL_MS,
+        flush_max_events=CLICK_FLUSH_MAX_EVENTS,
+    ):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_events = flush_max_events
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # the queue and thread don't survive a fork, e.g. gunicorn --preload
+        self._reset_worker()
+        self._queue = queue.Queue(self.maxsize)
+        self._aggregator = ClickAggregator()
+        self._closed = False
+        # global counts whose increment failed, added to the next one
+        self._unsaved_counts = {
+            "links": {"urls": 0, "emojis": 0},
+            "clicks": {"urls": 0, "emojis": 0},
+        }
+        self.counters = {
+            "enqueued": 0,
+            "written": 0,
+            "merged": 0,
+            "dropped": 0,
+            "failed": 0,
+            "errors": 0,
+            "flushes": 0,
+            "last_lag_seconds": 0.0,
+            "max_lag_seconds": 0.0,
+        }
+
+    def enqueue(self, event):
+        if self.policy == "sync" or self._closed:
+            aggregator = ClickAggregator()
+            aggregator.add(event)
+            self._flush(aggregator)
+            return True
+
+        self._ensure_worker()
+        try:
+            if self.policy == "block":
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+        except queue.Full:
+            self.counters["dropped"] += 1
+            return False
+
+        self.counters["enqueued"] += 1
+        return True
+
+    def count_links(self, is_emoji, count=1):
+        """
+        Add ``count`` created links to the global counters with the next flush.
+        """
+        if not count:
+            return
+        event = LinkCount(is_emoji, count)
+        if self.policy == "sync" or self._closed:
+            aggregator = ClickAggregator()
+            aggregator.add(event)
+            self._flush(aggregator)
+            return
+
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # the link exists, count it now rather than drop it
+            aggregator = ClickAggregator()
+            aggregator.add(event)
+            self._flush(aggregator)
+
+    def _run(self):
+        aggregator = self._aggregator
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                event = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                event = None
+
+            if event is self._STOP:
+                break
+            try:
+                if event is not None:
+                    aggregator.add(event)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+
+                if aggregator.events >= self.flush_max_events or (
+                    deadline is not None and time.monotonic() >= deadline
+                ):
+                    deadline = None
+                    self._flush(aggregator)
+            except Exception as e:
+                # one bad click or flush mustn't stop the writer
+                print(f"Error writing click analytics: {e}")
+                self.counters["errors"] += 1
+
+        self._flush(aggregator)
+
+    def _flush(self, aggregator):
+        if not aggregator.events and not any(aggregator.links.values()):
+            return
+
+        events = aggregator.events
+        links = len(aggregator)
+        oldest_click = aggregator.oldest_click
+        clicked = aggregator.keys()
+        counts = {"links": aggregator.links, "clicks": aggregator.clicks}
+        bucket_operations = aggregator.pop_bucket_operations()
+        url_operations = []
+        emoji_operations = []
+        for is_emoji, operation in aggregator.pop_operations():
+            if is_emoji:
+                emoji_operations.append(operation)
+            else:
+                url_operations.append(operation)
+
+        for name, operations, bulk_update in (
+            ("urls", url_operations, bulk_update_urls),
+            ("emojis", emoji_operations, bulk_update_emoji_urls),
+            ("buckets", bucket_operations, bulk_update_click_buckets),
+        ):
+            if not operations:
+                continue
+            if bulk_update(operations):
+                self.counters["written"] += len(operations)
+            else:
+                self.counters["failed"] += len(operations)
+
+        # one increment of the global totals per flush. The clicks are counted
+        # even if their analytics couldn't be written, they did happen.
+        with self._lock:
+            for field, unsaved in self._unsaved_counts.items():
+                for name, count in unsaved.items():
+                    counts[field][name] += count
+                    unsaved[name] = 0
+        if not increment_global_counters(**counts):
+            with self._lock:
+                for field, unsaved in self._unsaved_counts.items():
+                    for name, count in counts[field].items():
+                        unsaved[name] += count
+
+        if stats_rollup:
+            for is_emoji, short_code in clicked:
+                stats_rollup.mark(is_emoji, short_code)
+
+        self.counters["flushes"] += 1
+        if not events:
+            return
+        self.counters["merged"] += events - links
+        lag = (datetime.now(timezone.utc) - oldest_click).total_seconds()
+        self.counters["last_lag_seconds"] = lag
+        self.counters["max_lag_seconds"] = max(self.counters["max_lag_seconds"], lag)
+
+    def close(self, timeout=10):
+        """
+        Stop the worker thread and write whatever is still pending. Clicks
+        enqueued after this are written synchronously.
+        """
+        self._closed = True
+        if self._pid != os.getpid() or self._thread is None:
+            return
+
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return
+
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is not self._STOP:
+                self._aggregator.add(event)
+        self._flush(self._aggregator)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "restarts": self.restarts,
+            "queue_size": self._queue.qsize(),
+            "pending_events": self._aggregator.events,
+            "pending_links": len(self._aggregator),
+        }
+
+
+click_writer = ClickWriter()
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from utils.cache_utils import BackgroundWorker
+from utils.mongo_utils import (
+    claim_global_counters_reconciliation,
+    load_global_counters,
+    reconcile_global_counters,
+)
+
+# about every GLOBAL_COUNTERS_RECONCILE_INTERVAL seconds one process recounts
+# the /metric totals from the link collections, 0 turns it off
+GLOBAL_COUNTERS_RECONCILE_INTERVAL = float(
+    os.environ.get("GLOBAL_COUNTERS_RECONCILE_INTERVAL", 3600)
+)
+
+
+class CounterReconciler(BackgroundWorker):
+    """
+    Wakes up every ``interval`` seconds in a daemon thread and runs
+    ``reconcile`` if ``claim`` says this process is the one to do it.
+    """
+
+    worker_name = "counter-reconciler"
+
+    def __init__(self, claim, reconcile, interval):
+        self.claim = claim
+        self.reconcile = reconcile
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._reset_worker()
+        self.counters = {"runs": 0, "skipped": 0, "failed": 0, "last_drift": 0}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
+
+    def run_once(self):
+        if not self.claim(self.interval):
+            self.counters["skipped"] += 1
+            return
+        try:
+            drift = self.reconcile()
+        except Exception as e:
+            print(f"Error reconciling the global counters: {e}")
+            self.counters["failed"] += 1
+            return
+        self.counters["runs"] += 1
+        self.counters["last_drift"] = sum(
+            abs(count) for counts in drift.values() for count in counts.values()
+        )
+
+    def stats(self):
+        return dict(self.counters)
+
+
+global_counters_reconciler = CounterReconciler(
+    claim_global_counters_reconciliation,
+    reconcile_global_counters,
+    GLOBAL_COUNTERS_RECONCILE_INTERVAL,
+)
+
+
+def load_metric_totals():
+    """
+    Return the number of links and clicks of both collections from the global
+    counters. They are counted from scratch the first time.
+    """
+    if GLOBAL_COUNTERS_RECONCILE_INTERVAL:
+        global_counters_reconciler._ensure_worker()
+
+    counters = load_global_counters()
+    if counters is None or "reconciled-at" not in counters:
+        try:
+            reconcile_global_counters()
+        except Exception as e:
+            print(f"Error counting the global counters: {e}")
+        counters = load_global_counters() or {}
+
+    return {
+        "total-shortlinks": sum(counters.get("links", {}).values()),
+        "total-clicks": sum(counters.get("clicks", {}).values()),
+    }
@@ -0,0 +1,66 @@
+import ipaddress
+
+
+class IpPrefixTree:
+    """
+    Binary trie of network prefixes for one address family. A lookup follows
+    the bits of the address and stops at the first prefix it reaches, so it
+    costs at most one step per prefix bit.
+    """
+
+    def __init__(self, max_prefixlen):
+        self.max_prefixlen = max_prefixlen
+        self._root = {}
+
+    def add(self, network):
+        node = self._root
+        address = int(network.network_address)
+        for position in range(network.prefixlen):
+            if node.get("end"):
+                # a shorter prefix already covers this network
+                return
+            bit = (address >> (self.max_prefixlen - 1 - position)) & 1
+            node = node.setdefault(bit, {})
+        node["end"] = True
+
+    def __contains__(self, address):
+        node = self._root
+        address = int(address)
+        for position in range(self.max_prefixlen):
+            if node.get("end"):
+                return True
+            node = node.get((address >> (self.max_prefixlen - 1 - position)) & 1)
+            if node is None:
+                return False
+        return bool(node.get("end"))
+
+
+class IpBypassList:
+    """
+    IP addresses and CIDR ranges that skip rate limiting. Single addresses are
+    kept in a set, ranges in one prefix tree per address family.
+    """
+
+    def __init__(self, entries):
+        self.addresses = set()
+        self.networks = {4: IpPrefixTree(32), 6: IpPrefixTree(128)}
+        self.invalid = []
+
+        for entry in entries:
+            try:
+                if "/" in entry:
+                    network = ipaddress.ip_network(entry, strict=False)
+                    self.networks[network.version].add(network)
+                else:
+                    self.addresses.add(ipaddress.ip_address(entry))
+            except (TypeError, ValueError):
+                self.invalid.append(entry)
+
+    def __contains__(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        return address in self.addresses or address in self.networks[address.version]
@@ -0,0 +1,103 @@
+from datetime import datetime
+from utils.general import is_positive_integer
+from utils.mongo_utils import DEDUP_DESTINATIONS
+from utils.url_utils import (
+    get_destination_hash,
+    validate_alias,
+    validate_expiration_time,
+    validate_password,
+    validate_url,
+)
+
+
+def build_link(spec, is_blocked, creation_ip):
+    """
+    Validate the fields of a new link (``url``, ``password``, ``max-clicks``,
+    ``alias``, ``expiration-time`` and ``block-bots``), shared by the shorten
+    form and the bulk API. Returns ``(alias, data, error)``: the requested
+    alias, the link document to insert and the error response, if any.
+
+    With DEDUP_DESTINATIONS, links that can share a short code get a
+    ``destination-hash``.
+    """
+    url = spec.get("url")
+    password = spec.get("password")
+    max_clicks = spec.get("max-clicks")
+    alias = spec.get("alias")
+    expiration_time = spec.get("expiration-time")
+    block_bots = spec.get("block-bots")
+
+    if not url or not isinstance(url, str):
+        return None, None, {"UrlError": "URL is required"}
+
+    if not validate_url(url):
+        return (
+            None,
+            None,
+            {
+                "UrlError": "Invalid URL, URL must have a valid protocol and must follow rfc_1034 & rfc_2728 patterns"
+            },
+        )
+
+    if is_blocked(url):
+        return None, None, {"BlockedUrlError": "Blocked URL ⛔"}
+
+    if alias and (not isinstance(alias, str) or not validate_alias(alias)):
+        return None, None, {"AliasError": "Invalid Alias", "alias": f"{alias}"}
+
+    data = {"url": url, "counter": {}, "total-clicks": 0, "ips": []}
+
+    if password:
+        if not isinstance(password, str) or not validate_password(password):
+            return (
+                None,
+                None,
+                {
+                    "PasswordError": "Invalid password, password must be atleast 8 characters long, must contain a letter and a number and a special character either '@' or '.' and cannot be consecutive"
+                },
+            )
+        data["password"] = password
+
+    if max_clicks:
+        if not is_positive_integer(max_clicks):
+            return (
+                None,
+                None,
+                {"MaxClicksError": "max-clicks must be an positive integer"},
+            )
+        data["max-clicks"] = str(abs(int(str(max_clicks))))
+
+    # custom expiration time is currently really buggy and not ready for production
+    if expiration_time:
+        if not isinstance(expiration_time, str) or not validate_expiration_time(
+            expiration_time
+        ):
+            return (
+                None,
+                None,
+                {
+                    "ExpirationTimeError": "Invalid expiration-time. It must be in a valid ISO format with timezone information and at least 5 minutes from the current time."
+                },
+            )
+        data["expiration-time"] = expiration_time
+
+    if block_bots:
+        data["block-bots"] = True
+
+    now = datetime.now()
+    data["creation-date"] = now.strftime("%Y-%m-%d")
+    data["creation-time"] = now.strftime("%H:%M:%S")
+    data["creation-ip-address"] = creation_ip
+
+    # identical links share a code when DEDUP_DESTINATIONS is on, links
+    # with a click limit can't as they count clicks per link
+    if DEDUP_DESTINATIONS and not (alias or password or max_clicks):
+        data["destination-hash"] = get_destination_hash(
+            url,
+            {
+                "expiration-time": data.get("expiration-time"),
+                "block-bots": data.get("block-bots", False),
+            },
+        )
+
+    return alias or None, data, None
@@ -1,7 +1,17 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from dotenv import load_dotenv
+from utils.cache_utils import LRUCache, SingleFlight, VersionedCache
+from utils.bloom_utils import ShortCodeFilter
+from utils.blocklist_utils import BlockedUrlMatcher
+from utils.allocator_utils import ShortCodeAllocator
+from utils.ip_utils import IpBypassList
+from utils.pipeline_utils import get_summary_pipeline
+from datetime import datetime, timedelta, timezone
+import copy
 import os
-import re
+import secrets
+import time
 
 load_dotenv(override=True)
 
@@ -21,9 +31,296 @@ urls_collection = db["urls"]
 blocked_urls_collection = db["blocked-urls"]
 emoji_urls_collection = db["emojis"]
 ip_bypasses = db["ip-exceptions"]
+versions_collection = db["versions"]
+counters_collection = db["counters"]
+# materialized stats of every link, see utils/summary_utils.py
+url_summaries_collection = db["url-summaries"]
+emoji_summaries_collection = db["emoji-summaries"]
+# clicks per link and hour, see CLICK_BUCKETS
+click_buckets_collection = db["click-buckets"]
+
+DUPLICATE_KEY_ERROR = 11000
+
+# fields that decide where and whether a short link redirects, they are set by
+# insert_url and never change so they can be served from a per-process cache
+ROUTE_FIELDS = ("url", "password", "max-clicks", "expiration-time", "block-bots")
+ROUTE_PROJECTION = {"_id": 1, **{field: 1 for field in ROUTE_FIELDS}}
+# the fields the stats of a link change with, see load_stats_version
+STATS_VERSION_PROJECTION = {
+    "_id": 0,
+    "total-clicks": 1,
+    "last-click": 1,
+    **{field: 1 for field in ROUTE_FIELDS},
+}
+
+ROUTE_CACHE_SIZE = int(os.environ.get("ROUTE_CACHE_SIZE", 50000))
+ROUTE_CACHE_TTL = float(os.environ.get("ROUTE_CACHE_TTL", 300))
+
+route_cache = LRUCache(ROUTE_CACHE_SIZE, ttl=ROUTE_CACHE_TTL)
+# concurrent cache misses / stats aggregations for the same link share one query
+single_flight = SingleFlight()
+
+# Bloom filter of existing short codes so unknown codes can be answered with a
+# 404 without a query. Links created by other processes are picked up every
+# BLOOM_FILTER_REFRESH seconds, they can 404 in this process until then. With
+# BLOOM_FILTER_CHANGE_STREAM=true they are picked up as they are inserted
+# instead (needs a replica set).
+BLOOM_FILTER_ENABLED = os.environ.get("BLOOM_FILTER_ENABLED", "").lower() == "true"
+BLOOM_FILTER_CAPACITY = int(os.environ.get("BLOOM_FILTER_CAPACITY", 1000000))
+BLOOM_FILTER_ERROR_RATE = float(os.environ.get("BLOOM_FILTER_ERROR_RATE", 0.001))
+BLOOM_FILTER_REFRESH = float(os.environ.get("BLOOM_FILTER_REFRESH", 1))
+BLOOM_FILTER_CHANGE_STREAM = (
+    os.environ.get("BLOOM_FILTER_CHANGE_STREAM", "").lower() == "true"
+)
+
+
+def _scan_short_codes(since):
+    query = {} if since is None else {"created-at": {"$gte": since}}
+    for collection in (urls_collection, emoji_urls_collection):
+        for url_data in collection.find(query, {"_id": 1}):
+            yield _filter_key(collection, url_data["_id"])
+
+
+def _watch_short_codes(add, since):
+    pipeline = [
+        {
+            "$match": {
+                "operationType": "insert",
+                "ns.coll": {"$in": [urls_collection.name, emoji_urls_collection.name]},
+            }
+        }
+    ]
+    with db.watch(pipeline) as stream:
+        # links inserted before the stream opened
+        for key in _scan_short_codes(since):
+            add(key)
+        for change in stream:
+            key = f"{change['ns']['coll']}/{change['documentKey']['_id']}"
+            if not add(key):
+                return
+
+
+def _filter_key(collection, id):
+    return f"{collection.name}/{id}"
+
+
+short_code_filter = None
+if BLOOM_FILTER_ENABLED:
+    short_code_filter = ShortCodeFilter(
+        _scan_short_codes,
+        BLOOM_FILTER_CAPACITY,
+        BLOOM_FILTER_ERROR_RATE,
+        BLOOM_FILTER_REFRESH,
+        watch=_watch_short_codes if BLOOM_FILTER_CHANGE_STREAM else None,
+    )
+    try:
+        urls_collection.create_index("created-at")
+        emoji_urls_collection.create_index("created-at")
+    except Exception as e:
+        print(e)
+
+
+# generated short codes start at SHORT_CODE_LENGTH characters, every process
+# leases SHORT_CODE_BLOCK_SIZE counter values at a time
+SHORT_CODE_LENGTH = int(os.environ.get("SHORT_CODE_LENGTH", 6))
+SHORT_CODE_BLOCK_SIZE = int(os.environ.get("SHORT_CODE_BLOCK_SIZE", 100))
+# share of the codes of a length handed out before moving to the next length
+SHORT_CODE_MAX_FILL = float(os.environ.get("SHORT_CODE_MAX_FILL", 0.9))
+
+
+def _lease_short_codes(length, count):
+    counter = counters_collection.find_one_and_update(
+        {"_id": f"short-code-{length}"},
+        {"$inc": {"next": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter["next"] - count
+
+
+def _short_code_key():
+    """
+    Key of the short code permutation: SHORT_CODE_KEY (hex) if it is set,
+    otherwise a random key generated once and kept in the counters collection.
+    """
+    key = os.environ.get("SHORT_CODE_KEY")
+    if key:
+        return bytes.fromhex(key)
+    for _ in range(2):
+        try:
+            counter = counters_collection.find_one_and_update(
+                {"_id": "short-code-key"},
+                {"$setOnInsert": {"key": secrets.token_hex(32)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            return bytes.fromhex(counter["key"])
+        except DuplicateKeyError:
+            # another process created it at the same time
+            continue
+    raise RuntimeError("Could not load the short code key")
+
+
+short_code_allocator = ShortCodeAllocator(
+    _lease_short_codes,
+    _short_code_key,
+    min_length=SHORT_CODE_LENGTH,
+    block_size=SHORT_CODE_BLOCK_SIZE,
+    max_fill=SHORT_CODE_MAX_FILL,
+)
+
+
+# with DEDUP_DESTINATIONS=true, links without password, alias or click limit
+# that lead to the same destination with the same options share a short code
+DEDUP_DESTINATIONS = os.environ.get("DEDUP_DESTINATIONS", "").lower() == "true"
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", 10000))
+DEDUP_CACHE_TTL = float(os.environ.get("DEDUP_CACHE_TTL", 300))
+
+# destination hash -> short code of recently created or reused links
+destination_cache = LRUCache(DEDUP_CACHE_SIZE, ttl=DEDUP_CACHE_TTL)
+
+if DEDUP_DESTINATIONS:
+    try:
+        urls_collection.create_index("destination-hash", sparse=True)
+    except Exception as e:
+        print(e)
+
+
+# with CLICK_BUCKETS=true daily clicks and unique visitors are counted in one
+# document per link and hour in click-buckets instead of the counter and
+# unique_counter maps of the link document, and the stats routes only read the
+# buckets of the window they show
+CLICK_BUCKETS = os.environ.get("CLICK_BUCKETS", "").lower() == "true"
+
+if CLICK_BUCKETS:
+    try:
+        click_buckets_collection.create_index(
+            [("link", 1), ("emoji", 1), ("hour", 1)], unique=True
+        )
+    except Exception as e:
+        print(e)
+
+
+def bulk_update_click_buckets(operations):
+    try:
+        click_buckets_collection.bulk_write(operations, ordered=False)
+    except Exception:
+        return False
+    return True
+
+
+def load_click_buckets(short_code, is_emoji, since, until=None):
+    """
+    Return the click buckets of a link from the hour ``since`` (UTC) on, up
+    to but not including ``until``.
+    """
+    hours = {"$gte": since}
+    if until is not None:
+        hours["$lt"] = until
+    try:
+        return list(
+            click_buckets_collection.find(
+                {"link": short_code, "emoji": is_emoji, "hour": hours},
+                {
+                    "_id": 0,
+                    "hour": 1,
+                    "clicks": 1,
+                    "migrated_clicks": 1,
+                    "unique": 1,
+                    "hll": 1,
+                },
+            )
+        )
+    except Exception as e:
+        print(f"Error loading the clicks of {short_code}: {e}")
+        return []
+
+
+def find_url_by_destination(destination_hash):
+    """
+    Return the short code of a link created with the same destination hash,
+    or None.
+    """
+    short_code = destination_cache.get(destination_hash)
+    if short_code is not None:
+        return short_code
+    try:
+        url_data = urls_collection.find_one(
+            {"destination-hash": destination_hash}, {"_id": 1}
+        )
+    except Exception:
+        url_data = None
+    if url_data is None:
+        return None
+    destination_cache.set(destination_hash, url_data["_id"])
+    return url_data["_id"]
+
+
+def _load_route(collection, id, projection):
+    """
+    Read-through lookup of the routing fields, used when ``projection`` only
+    asks for fields in ROUTE_PROJECTION.
+    """
+    key = (collection.name, id)
+    route = route_cache.get(key)
+    if route is None:
+        if short_code_filter and not short_code_filter.might_exist(
+            _filter_key(collection, id)
+        ):
+            return None
+        route, _ = single_flight.do(
+            ("find_one", *key), _fetch_route, collection, id, key
+        )
+        if route is None:
+            return None
+
+    url_data = {"_id": route["_id"]}
+    url_data.update((field, route[field]) for field in projection if field in route)
+    return url_data
+
+
+def _fetch_route(collection, id, key):
+    try:
+        route = collection.find_one({"_id": id}, ROUTE_PROJECTION)
+    except Exception:
+        return None
+    if route is not None:
+        route_cache.set(key, route)
+    return route
+
+
+def _aggregate_one(collection, pipeline):
+    try:
+        return list(collection.aggregate(pipeline))[0]
+    except Exception:
+        return None
+
+
+def _shared_aggregate(collection, pipeline):
+    """
+    Run a single-document aggregation, sharing the result with concurrent
+    identical aggregations. Callers modify the returned document, so every
+    caller, including the one that ran the query, gets its own copy and the
+    shared result is never changed while others still copy it.
+    """
+    key = ("aggregate", collection.name, repr(pipeline))
+    data, _ = single_flight.do(key, _aggregate_one, collection, pipeline)
+    return copy.deepcopy(data)
+
+
+def _is_route_projection(projection):
+    return projection is not None and all(
+        field in ROUTE_PROJECTION and value for field, value in projection.items()
+    )
+
+
+def invalidate_route(collection, id):
+    route_cache.pop((collection.name, id))
 
 
 def load_url(id, projection=None):
+    if _is_route_projection(projection):
+        return _load_route(urls_collection, id, projection)
     try:
         url_data = urls_collection.find_one({"_id": id}, projection)
     except Exception:
@@ -32,38 +329,208 @@ def load_url(id, projection=None):
 
 
 def aggregate_url(pipeline):
+    return _shared_aggregate(urls_collection, pipeline)
+
+
+# link and click totals of both collections for /metric, in one document of
+# the counters collection: {"links": {"urls": n, "emojis": n}, "clicks": ...}.
+# The click writer increments it with the links and clicks of every flush,
+# reconcile_global_counters recounts it.
+GLOBAL_COUNTERS_ID = "global-counters"
+LINK_COLLECTIONS = {"urls": urls_collection, "emojis": emoji_urls_collection}
+
+
+def increment_global_counters(links=None, clicks=None):
+    """
+    Add ``{"urls": n, "emojis": n}`` link and click counts to the totals,
+    returns False if that failed.
+    """
+    updates = {}
+    for field, counts in (("links", links), ("clicks", clicks)):
+        for name, count in (counts or {}).items():
+            if count:
+                updates[f"{field}.{name}"] = count
+    if not updates:
+        return True
+    try:
+        counters_collection.update_one(
+            {"_id": GLOBAL_COUNTERS_ID}, {"$inc": updates}, upsert=True
+        )
+    except Exception as e:
+        print(f"Error updating the global counters: {e}")
+        return False
+    return True
+
+
+def load_global_counters():
     try:
-        url_data = urls_collection.aggregate(pipeline)
-        url_data = list(url_data)[0]
+        return counters_collection.find_one({"_id": GLOBAL_COUNTERS_ID})
     except Exception:
-        url_data = None
-    return url_data
+        return None
+
+
+def claim_global_counters_reconciliation(interval):
+    """
+    Returns True for the one process that gets to recount the totals once
+    every ``interval`` seconds.
+    """
+    now = datetime.now(timezone.utc)
+    due = now - timedelta(seconds=interval)
+    try:
+        counters_collection.update_one(
+            {
+                "_id": GLOBAL_COUNTERS_ID,
+                "$or": [
+                    {"reconciled-at": {"$lt": due}},
+                    {"reconciled-at": {"$exists": False}},
+                ],
+            },
+            {"$set": {"reconciled-at": now}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # the document exists and was reconciled recently
+        return False
+    except Exception as e:
+        print(f"Error claiming the global counters reconciliation: {e}")
+        return False
+    return True
+
+
+def reconcile_global_counters():
+    """
+    Recount the links and clicks of both collections and overwrite the totals,
+    returns the drift that was corrected. Increments made while the recount
+    runs can be counted twice or lost, the next reconciliation fixes them.
+    """
+    totals = {"links": {}, "clicks": {}}
+    for name, collection in LINK_COLLECTIONS.items():
+        result = next(
+            collection.aggregate(
+                [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "links": {"$sum": 1},
+                            "clicks": {"$sum": "$total-clicks"},
+                        }
+                    }
+                ]
+            ),
+            {"links": 0, "clicks": 0},
+        )
+        totals["links"][name] = result["links"]
+        totals["clicks"][name] = result["clicks"]
+
+    previous = load_global_counters() or {}
+    drift = {
+        field: {
+            name: count - previous.get(field, {}).get(name, 0)
+            for name, count in counts.items()
+        }
+        for field, counts in totals.items()
+    }
+    counters_collection.update_one(
+        {"_id": GLOBAL_COUNTERS_ID},
+        {
+            "$set": {
+                "links": totals["links"],
+                "clicks": totals["clicks"],
+                "reconciled-at": datetime.now(timezone.utc),
+            }
+        },
+        upsert=True,
+    )
+    return drift
 
 
 def insert_url(id, url_data):
+    """
+    Returns False when the short code is already taken.
+    """
     try:
-        urls_collection.insert_one({"_id": id, **url_data})
-    except Exception:
-        pass
+        urls_collection.insert_one(
+            {"_id": id, **url_data, "created-at": datetime.now(timezone.utc)}
+        )
+    except DuplicateKeyError:
+        return False
+    if short_code_filter:
+        short_code_filter.add(_filter_key(urls_collection, id))
+    if "destination-hash" in url_data:
+        destination_cache.set(url_data["destination-hash"], id)
+    invalidate_route(urls_collection, id)
+    return True
 
 
-def update_url(id, updates):
+def insert_urls(documents):
+    """
+    Insert many links with one unordered insert_many. Returns ``(duplicates,
+    failed)``, the indexes of the documents whose short code was already taken
+    and of those that couldn't be written for another reason.
+    """
+    created_at = datetime.now(timezone.utc)
+    documents = [{**document, "created-at": created_at} for document in documents]
+    duplicates = set()
+    failed = set()
     try:
-        urls_collection.update_one({"_id": id}, updates)
+        urls_collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            if error["code"] == DUPLICATE_KEY_ERROR:
+                duplicates.add(error["index"])
+            else:
+                failed.add(error["index"])
+
+    for index, document in enumerate(documents):
+        if index in duplicates or index in failed:
+            continue
+        if short_code_filter:
+            short_code_filter.add(_filter_key(urls_collection, document["_id"]))
+        if "destination-hash" in document:
+            destination_cache.set(document["destination-hash"], document["_id"])
+        invalidate_route(urls_collection, document["_id"])
+    return duplicates, failed
+
+
+def load_url_summary(id):
+    try:
+        return url_summaries_collection.find_one({"_id": id})
     except Exception:
-        pass
+        return None
+
+
+def load_url_stats_version(id, summary=False):
+    collection = url_summaries_collection if summary else urls_collection
+    return _load_stats_version(collection, id)
+
 
+def summarize_urls(ids):
+    """
+    Recompute the stats summaries of ``ids`` on the server, returns False if
+    that failed.
+    """
+    return _summarize(urls_collection, url_summaries_collection, ids)
 
-def check_if_slug_exists(slug):
-    projection = {"_id": 1}
+
+def reserve_url_click(id, max_clicks):
+    """
+    Atomically count a click on a link with a click limit, returns False once
+    the limit has been reached.
+    """
+    return _reserve_click(urls_collection, id, max_clicks)
+
+
+def bulk_update_urls(operations):
     try:
-        url_data = urls_collection.find_one({"_id": slug}, projection)
+        urls_collection.bulk_write(operations, ordered=False)
     except Exception:
-        url_data = None
-    return url_data is not None
+        return False
+    return True
 
 
 def load_emoji_url(alias, projection=None):
+    if _is_route_projection(projection):
+        return _load_route(emoji_urls_collection, alias, projection)
     try:
         emoji_data = emoji_urls_collection.find_one({"_id": alias}, projection)
     except Exception:
@@ -72,42 +539,174 @@ def load_emoji_url(alias, projection=None):
 
 
 def aggregate_emoji_url(pipeline):
+    return _shared_aggregate(emoji_urls_collection, pipeline)
+
+
+def insert_emoji_url(alias, emoji_data):
+    """
+    Returns False when the emoji alias is already taken.
+    """
     try:
-        emoji_data = emoji_urls_collection.aggregate(pipeline)
-        emoji_data = list(emoji_data)[0]
+        emoji_urls_collection.insert_one(
+            {"_id": alias, **emoji_data, "created-at": datetime.now(timezone.utc)}
+        )
+    except DuplicateKeyError:
+        return False
+    if short_code_filter:
+        short_code_filter.add(_filter_key(emoji_urls_collection, alias))
+    invalidate_route(emoji_urls_collection, alias)
+    return True
+
+
+def load_emoji_url_summary(alias):
+    try:
+        return emoji_summaries_collection.find_one({"_id": alias})
     except Exception:
-        emoji_data = None
-    return emoji_data
+        return None
 
 
-def insert_emoji_url(alias, emoji_data):
+def load_emoji_url_stats_version(alias, summary=False):
+    collection = emoji_summaries_collection if summary else emoji_urls_collection
+    return _load_stats_version(collection, alias)
+
+
+def summarize_emoji_urls(aliases):
+    return _summarize(emoji_urls_collection, emoji_summaries_collection, aliases)
+
+
+def reserve_emoji_url_click(alias, max_clicks):
+    return _reserve_click(emoji_urls_collection, alias, max_clicks)
+
+
+def bulk_update_emoji_urls(operations):
     try:
-        emoji_urls_collection.insert_one({"_id": alias, **emoji_data})
+        emoji_urls_collection.bulk_write(operations, ordered=False)
     except Exception:
-        pass
+        return False
+    return True
 
 
-def update_emoji_url(alias, updates):
+def _load_stats_version(collection, id):
     try:
-        emoji_urls_collection.update_one({"_id": alias}, updates)
+        return collection.find_one({"_id": id}, STATS_VERSION_PROJECTION)
     except Exception:
-        pass
+        return None
+
+
+def _summarize(collection, summaries_collection, ids):
+    try:
+        collection.aggregate(get_summary_pipeline(ids, summaries_collection.name))
+    except Exception as e:
+        print(f"Error updating the stats summaries: {e}")
+        return False
+    return True
 
 
-def check_if_emoji_alias_exists(emoji_alias):
+def _reserve_click(collection, id, max_clicks):
     try:
-        emoji_data = emoji_urls_collection.find_one({"_id": emoji_alias})
+        url_data = collection.find_one_and_update(
+            {"_id": id, "total-clicks": {"$lt": int(max_clicks)}},
+            {"$inc": {"total-clicks": 1}},
+            projection={"_id": 1},
+        )
     except Exception:
-        emoji_data = None
-    return emoji_data is not None
+        return False
+    return url_data is not None
+
+
+# the blocked url matcher is rebuilt when the "blocked-urls" version stamp in
+# the versions collection changes (see bump_blocklist_version), checked every
+# BLOCKLIST_CHECK_INTERVAL seconds, and at least every BLOCKLIST_MAX_AGE
+# seconds for edits that didn't bump it. With BLOCKLIST_CHANGE_STREAM=true
+# changes are also picked up from a change stream (needs a replica set).
+BLOCKLIST_CHECK_INTERVAL = float(os.environ.get("BLOCKLIST_CHECK_INTERVAL", 5))
+BLOCKLIST_MAX_AGE = float(os.environ.get("BLOCKLIST_MAX_AGE", 300))
+BLOCKLIST_CHANGE_STREAM = (
+    os.environ.get("BLOCKLIST_CHANGE_STREAM", "").lower() == "true"
+)
+
+
+def _load_version(collection):
+    doc = versions_collection.find_one({"_id": collection.name})
+    return doc["version"] if doc else None
+
+
+def _bump_version(collection):
+    versions_collection.update_one(
+        {"_id": collection.name}, {"$inc": {"version": 1}}, upsert=True
+    )
+
+
+def _load_blocked_url_matcher():
+    return BlockedUrlMatcher(doc["_id"] for doc in blocked_urls_collection.find())
+
+
+def _watch_blocked_urls(on_change):
+    while True:
+        try:
+            with blocked_urls_collection.watch() as stream:
+                for _ in stream:
+                    on_change()
+        except Exception as e:
+            print(f"Error watching the blocked url list: {e}")
+        on_change()
+        time.sleep(BLOCKLIST_CHECK_INTERVAL)
+
+
+blocked_url_cache = VersionedCache(
+    "blocked url list",
+    _load_blocked_url_matcher,
+    lambda: _load_version(blocked_urls_collection),
+    BLOCKLIST_CHECK_INTERVAL,
+    BLOCKLIST_MAX_AGE,
+    watch=_watch_blocked_urls if BLOCKLIST_CHANGE_STREAM else None,
+)
+
+
+def bump_blocklist_version():
+    """
+    Tell every app process to reload the blocked url list, call it after
+    changing the blocked-urls collection.
+    """
+    _bump_version(blocked_urls_collection)
+    blocked_url_cache.invalidate()
 
 
 def validate_blocked_url(url):
-    blocked_urls = blocked_urls_collection.find()
-    blocked_urls = [doc["_id"] for doc in blocked_urls]
+    return not blocked_url_cache.get().is_blocked(url)
 
-    for blocked_url in blocked_urls:
-        if re.match(blocked_url, url):
-            return False
 
-    return True
+# the ip bypass list is reloaded the same way, from the "ip-exceptions"
+# version stamp (see bump_ip_bypass_version)
+IP_BYPASS_CHECK_INTERVAL = float(os.environ.get("IP_BYPASS_CHECK_INTERVAL", 5))
+IP_BYPASS_MAX_AGE = float(os.environ.get("IP_BYPASS_MAX_AGE", 300))
+
+
+def _load_ip_bypass_list():
+    return IpBypassList(doc["_id"] for doc in ip_bypasses.find())
+
+
+ip_bypass_cache = VersionedCache(
+    "ip bypass list",
+    _load_ip_bypass_list,
+    lambda: _load_version(ip_bypasses),
+    IP_BYPASS_CHECK_INTERVAL,
+    IP_BYPASS_MAX_AGE,
+)
+
+
+def bump_ip_bypass_version():
+    """
+    Tell every app process to reload the ip bypass list, call it after
+    changing the ip-exceptions collection.
+    """
+    _bump_version(ip_bypasses)
+    ip_bypass_cache.invalidate()
+
+
+def is_ip_bypassed(ip):
+    """
+    Whether ``ip`` is in the ip-exceptions collection, as a single address or
+    inside one of its CIDR ranges.
+    """
+    return ip in ip_bypass_cache.get()
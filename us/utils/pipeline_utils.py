@@ -1,3 +1,25 @@
+from utils.hll_utils import SKETCH_MODE, VISITORS_SKETCH, DAILY_VISITORS_SKETCH
+
+STATS_DIMENSIONS = ("browser", "os_name", "country", "referrer")
+# fields every stats response is computed from, whatever fields were asked for
+STATS_BASE_FIELDS = (
+    "password",
+    "total-clicks",
+    "max-clicks",
+    "expiration-time",
+    "creation-date",
+)
+
+
+def _unique_visitors(ips, sketch):
+    # in sketch mode the raw sketch is returned and estimated by
+    # resolve_unique_counts, documents that weren't migrated yet still have ips
+    ip_count = {"$size": {"$setUnion": [{"$ifNull": [ips, []]}]}}
+    if SKETCH_MODE:
+        return {"$ifNull": [sketch, ip_count]}
+    return ip_count
+
+
 def _create_field_transform(field_name):
     return {
         f"{field_name}": {
@@ -16,7 +38,7 @@ def _create_field_transform(field_name):
                     "as": "item",
                     "in": {
                         "k": "$$item.k",
-                        "v": {"$size": {"$setUnion": ["$$item.v.ips"]}},
+                        "v": _unique_visitors("$$item.v.ips", "$$item.v.hll"),
                     },
                 }
             }
@@ -24,41 +46,123 @@ def _create_field_transform(field_name):
     }
 
 
-def get_stats_pipeline(short_code):
-    fields = ["browser", "os_name", "country", "referrer"]
+def _top_values(field, top, sort_by):
+    # the ``top`` entries of a {value: ...} map, by clicks
+    return {
+        "$arrayToObject": {
+            "$slice": [
+                {
+                    "$sortArray": {
+                        "input": {"$objectToArray": {"$ifNull": [f"${field}", {}]}},
+                        "sortBy": {sort_by: -1},
+                    }
+                },
+                top,
+            ]
+        }
+    }
+
+
+def _date_range(field, since, until):
+    # the entries of a {"YYYY-MM-DD": ...} map from since to until
+    conditions = []
+    if since:
+        conditions.append({"$gte": ["$$day.k", since]})
+    if until:
+        conditions.append({"$lte": ["$$day.k", until]})
+    return {
+        "$arrayToObject": {
+            "$filter": {
+                "input": {"$objectToArray": {"$ifNull": [f"${field}", {}]}},
+                "as": "day",
+                "cond": {"$and": conditions},
+            }
+        }
+    }
+
+
+def _stats_stages(fields=None, top=None, since=None, until=None):
+    """
+    ``fields`` limits the projection to the fields asked for, ``top`` keeps
+    the most clicked values of every dimension and of the bots, ``since`` and
+    ``until`` cut the daily counters to a date range.
+    """
+    dimensions = STATS_DIMENSIONS
+    if fields:
+        dimensions = [
+            field
+            for field in STATS_DIMENSIONS
+            if field in fields or f"unique_{field}" in fields
+        ]
     add_fields = {}
-    for field in fields:
+    for field in dimensions:
         add_fields |= _create_field_transform(field)
 
+    projection = {
+        "url": 1,
+        "browser": {"$ifNull": ["$browser", {}]},
+        "os_name": {"$ifNull": ["$os_name", {}]},
+        "country": {"$ifNull": ["$country", {}]},
+        "referrer": {"$ifNull": ["$referrer", {}]},
+        "total_unique_clicks": _unique_visitors("$ips", f"${VISITORS_SKETCH}"),
+        "total-clicks": {"$ifNull": ["$total-clicks", 0]},
+        "max-clicks": {"$ifNull": ["$max-clicks", None]},
+        "expiration-time": {"$ifNull": ["$expiration-time", None]},
+        "password": {"$ifNull": ["$password", None]},
+        "short_code": {"$ifNull": ["$short_code", None]},
+        "last-click-browser": {"$ifNull": ["$last-click-browser", None]},
+        "last-click-os": {"$ifNull": ["$last-click-os", None]},
+        "last-click-country": {"$ifNull": ["$last-click-country", None]},
+        "block-bots": {"$ifNull": ["$block-bots", False]},
+        "bots": {"$ifNull": ["$bots", {}]},
+        "counter": {"$ifNull": ["$counter", {}]},
+        "unique_counter": {"$ifNull": ["$unique_counter", {}]},
+        "average_redirection_time": {"$ifNull": ["$average_redirection_time", 0]},
+        "creation-date": {"$ifNull": ["$creation-date", None]},
+        "creation-time": {"$ifNull": ["$creation-time", None]},
+        "last-click": {"$ifNull": ["$last-click", None]},
+    }
+    if SKETCH_MODE:
+        projection[DAILY_VISITORS_SKETCH] = {
+            "$ifNull": [f"${DAILY_VISITORS_SKETCH}", {}]
+        }
+
+    if top:
+        for field in STATS_DIMENSIONS:
+            projection[field] = _top_values(field, top, "v.counts")
+        projection["bots"] = _top_values("bots", top, "v")
+    if since or until:
+        for field in ("counter", "unique_counter", DAILY_VISITORS_SKETCH):
+            if field in projection:
+                projection[field] = _date_range(field, since, until)
+    if fields:
+        keep = {*fields, *STATS_BASE_FIELDS, *dimensions}
+        if "unique_counter" in fields:
+            keep.add(DAILY_VISITORS_SKETCH)
+        projection = {
+            field: value for field, value in projection.items() if field in keep
+        }
+
+    stages = [{"$project": projection}]
+    if add_fields:
+        stages.append({"$addFields": add_fields})
+    return stages
+
+
+def get_stats_pipeline(short_code, fields=None, top=None, since=None, until=None):
     return [
         {"$match": {"_id": short_code}},
-        {
-            "$project": {
-                "url": 1,
-                "browser": {"$ifNull": ["$browser", {}]},
-                "os_name": {"$ifNull": ["$os_name", {}]},
-                "country": {"$ifNull": ["$country", {}]},
-                "referrer": {"$ifNull": ["$referrer", {}]},
-                "total_unique_clicks": {"$size": "$ips"},
-                "total-clicks": {"$ifNull": ["$total-clicks", 0]},
-                "max-clicks": {"$ifNull": ["$max-clicks", None]},
-                "expiration-time": {"$ifNull": ["$expiration-time", None]},
-                "password": {"$ifNull": ["$password", None]},
-                "short_code": {"$ifNull": ["$short_code", None]},
-                "last-click-browser": {"$ifNull": ["$last-click-browser", None]},
-                "last-click-os": {"$ifNull": ["$last-click-os", None]},
-                "last-click-country": {"$ifNull": ["$last-click-country", None]},
-                "block-bots": {"$ifNull": ["$block-bots", False]},
-                "bots": {"$ifNull": ["$bots", {}]},
-                "counter": {"$ifNull": ["$counter", {}]},
-                "unique_counter": {"$ifNull": ["$unique_counter", {}]},
-                "average_redirection_time": {
-                    "$ifNull": ["$average_redirection_time", 0]
-                },
-                "creation-date": {"$ifNull": ["$creation-date", None]},
-                "creation-time": {"$ifNull": ["$creation-time", None]},
-                "last-click": {"$ifNull": ["$last-click", None]},
-            }
-        },
-        {"$addFields": add_fields},
+        *_stats_stages(fields, top, since, until),
+    ]
+
+
+def get_summary_pipeline(short_codes, into):
+    """
+    Compute the stats of ``short_codes`` like get_stats_pipeline and store
+    them in the ``into`` collection, one summary document per link.
+    """
+    return [
+        {"$match": {"_id": {"$in": list(short_codes)}}},
+        *_stats_stages(),
+        {"$merge": {"into": into, "whenMatched": "replace"}},
     ]
@@ -0,0 +1,204 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from limits.storage import Storage
+from pymongo import MongoClient, UpdateOne
+from utils.cache_utils import BackgroundWorker
+
+
+class ReconcilingStorage(Storage, BackgroundWorker):
+    """
+    Fixed window rate limit storage that counts hits in process memory and
+    reconciles them with MongoDB in the background.
+
+    ``incr`` only updates a dict: the count it returns is the window's global
+    count as of the last sync plus the hits this process took since. Every
+    ``sync_interval`` seconds the pending hits of all keys are added to the
+    shared counters with one bulk write and the global counts are read back
+    with one query. The documents have the same shape as the ones of the
+    ``mongodb://`` storage of the limits package, in the same ``limits``
+    database, so both can be used side by side.
+
+    Approximation: a process never lets its own hits go over a limit, but it
+    doesn't see the hits other processes took since the last sync. With N
+    processes (workers on every node) serving a key, the key can go over its
+    limit by at most the hits the other N - 1 processes accept for it during
+    one sync interval, and never by more than (N - 1) times the limit. If
+    MongoDB is unreachable every process limits on its own counts.
+
+    Used with ``storage_uri="local+" + MONGO_URI``.
+    """
+
+    STORAGE_SCHEME = ["local+mongodb", "local+mongodb+srv"]
+    worker_name = "rate-limit-sync"
+
+    def __init__(
+        self,
+        uri,
+        wrap_exceptions=False,
+        sync_interval=1.0,
+        database_name="limits",
+        counter_collection_name="counters",
+        **options,
+    ):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self._mongo_uri = uri[len("local+") :]
+        self._options = options
+        self.sync_interval = float(sync_interval)
+        self._database_name = database_name
+        self._counter_collection_name = counter_collection_name
+        self._client = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # the counts and the sync thread don't survive a fork
+        self._reset_worker()
+        # key -> [expires at, global count, pending hits, hits being synced,
+        #         window length]
+        self._windows = {}
+        self.syncs = 0
+        self.failed_syncs = 0
+
+    @property
+    def base_exceptions(self):
+        return ValueError
+
+    @property
+    def counters(self):
+        if self._client is None:
+            self._client = MongoClient(self._mongo_uri, **self._options)
+            counters = self._client[self._database_name][self._counter_collection_name]
+            counters.create_index("expireAt", expireAfterSeconds=0)
+        return self._client[self._database_name][self._counter_collection_name]
+
+    def _window(self, key, now):
+        window = self._windows.get(key)
+        if window is not None and window[0] <= now:
+            del self._windows[key]
+            window = None
+        return window
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        self._ensure_worker()
+        now = time.time()
+        with self._lock:
+            window = self._window(key, now)
+            if window is None:
+                window = self._windows[key] = [now + expiry, 0, 0, 0, expiry]
+            elif elastic_expiry:
+                window[0] = now + expiry
+            window[2] += amount
+            return window[1] + window[2] + window[3]
+
+    def get(self, key):
+        with self._lock:
+            window = self._window(key, time.time())
+            return window[1] + window[2] + window[3] if window else 0
+
+    def get_expiry(self, key):
+        with self._lock:
+            window = self._window(key, time.time())
+            return int(window[0]) if window else int(time.time())
+
+    def check(self):
+        return True
+
+    def clear(self, key):
+        with self._lock:
+            self._windows.pop(key, None)
+        try:
+            self.counters.delete_one({"_id": key})
+        except Exception as e:
+            print(f"Error clearing rate limit {key}: {e}")
+
+    def reset(self):
+        with self._lock:
+            count = len(self._windows)
+            self._windows.clear()
+        return count
+
+    def _run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            self.sync()
+
+    def sync(self):
+        """
+        Push the pending hits of every live window and read back the global
+        counts.
+        """
+        now = time.time()
+        with self._lock:
+            for key in [key for key, w in self._windows.items() if w[0] <= now]:
+                del self._windows[key]
+            windows = dict(self._windows)
+            for window in windows.values():
+                window[3] += window[2]
+                window[2] = 0
+        if not windows:
+            return
+
+        operations = []
+        for key, window in windows.items():
+            if not window[3]:
+                continue
+            expiration = datetime.now(timezone.utc) + timedelta(seconds=window[4])
+            expired = {"$lt": ["$expireAt", "$$NOW"]}
+            operations.append(
+                UpdateOne(
+                    {"_id": key},
+                    [
+                        {
+                            "$set": {
+                                "count": {
+                                    "$cond": [
+                                        expired,
+                                        window[3],
+                                        {"$add": ["$count", window[3]]},
+                                    ]
+                                },
+                                "expireAt": {
+                                    "$cond": [expired, expiration, "$expireAt"]
+                                },
+                            }
+                        }
+                    ],
+                    upsert=True,
+                )
+            )
+
+        try:
+            if operations:
+                self.counters.bulk_write(operations, ordered=False)
+            counts = {
+                doc["_id"]: doc
+                for doc in self.counters.find({"_id": {"$in": list(windows)}})
+            }
+        except Exception as e:
+            self.failed_syncs += 1
+            print(f"Error syncing rate limits: {e}")
+            with self._lock:
+                # keep counting them locally and try again next time
+                for window in windows.values():
+                    window[2] += window[3]
+                    window[3] = 0
+            return
+
+        with self._lock:
+            for key, window in windows.items():
+                doc = counts.get(key)
+                window[3] = 0
+                if doc is None:
+                    # the shared window expired
+                    window[1] = 0
+                    continue
+                window[1] = doc["count"]
+                expire_at = doc.get("expireAt")
+                if expire_at is None:
+                    continue
+                if expire_at.tzinfo is None:
+                    expire_at = expire_at.replace(tzinfo=timezone.utc)
+                # follow the window of the first process that opened it
+                window[0] = expire_at.timestamp()
+        self.syncs += 1
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from utils.cache_utils import BackgroundWorker
+from utils.mongo_utils import (
+    aggregate_url,
+    aggregate_emoji_url,
+    load_url_summary,
+    load_emoji_url_summary,
+    load_url_stats_version,
+    load_emoji_url_stats_version,
+    summarize_urls,
+    summarize_emoji_urls,
+)
+from utils.pipeline_utils import get_stats_pipeline
+
+# with STATS_SUMMARIES=true the stats routes read a summary document per link
+# instead of running the stats pipeline. Summaries of clicked links are
+# recomputed every STATS_ROLLUP_INTERVAL seconds, so stats can be that much
+# behind the clicks.
+STATS_SUMMARIES = os.environ.get("STATS_SUMMARIES", "").lower() == "true"
+STATS_ROLLUP_INTERVAL = float(os.environ.get("STATS_ROLLUP_INTERVAL", 30))
+STATS_ROLLUP_BATCH_SIZE = int(os.environ.get("STATS_ROLLUP_BATCH_SIZE", 500))
+
+
+class SummaryRollup(BackgroundWorker):
+    """
+    Collects the links whose stats changed and recomputes their summaries in a
+    daemon thread, ``batch_size`` links per aggregation.
+    """
+
+    worker_name = "stats-rollup"
+
+    def __init__(self, summarize, summarize_emoji, interval, batch_size):
+        self.summarize = summarize
+        self.summarize_emoji = summarize_emoji
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._reset_worker()
+        self._dirty = {False: set(), True: set()}
+        self.counters = {"rollups": 0, "links": 0, "failed": 0}
+
+    def mark(self, is_emoji, short_code):
+        self._ensure_worker()
+        with self._lock:
+            self._dirty[is_emoji].add(short_code)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.roll_up()
+
+    def roll_up(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {False: set(), True: set()}
+
+        for is_emoji, short_codes in dirty.items():
+            summarize = self.summarize_emoji if is_emoji else self.summarize
+            short_codes = list(short_codes)
+            for start in range(0, len(short_codes), self.batch_size):
+                batch = short_codes[start : start + self.batch_size]
+                if summarize(batch):
+                    self.counters["links"] += len(batch)
+                else:
+                    self.counters["failed"] += len(batch)
+                    # try again with the next roll-up
+                    with self._lock:
+                        self._dirty[is_emoji].update(batch)
+        self.counters["rollups"] += 1
+
+    def stats(self):
+        return {
+            **self.counters,
+            "pending": len(self._dirty[False]) + len(self._dirty[True]),
+        }
+
+
+stats_rollup = None
+if STATS_SUMMARIES:
+    stats_rollup = SummaryRollup(
+        summarize_urls,
+        summarize_emoji_urls,
+        STATS_ROLLUP_INTERVAL,
+        STATS_ROLLUP_BATCH_SIZE,
+    )
+
+
+def load_stats(short_code, is_emoji, selection=None):
+    """
+    Return the stats of a link as computed by get_stats_pipeline, from its
+    summary when summaries are enabled. Links without a summary yet get the
+    pipeline and are summarized with the next roll-up. A ``selection`` of
+    fields, top values or dates is always computed by the pipeline.
+    """
+    if selection:
+        pipeline = get_stats_pipeline(short_code, **selection)
+        if is_emoji:
+            return aggregate_emoji_url(pipeline)
+        return aggregate_url(pipeline)
+
+    if stats_rollup:
+        if is_emoji:
+            summary = load_emoji_url_summary(short_code)
+        else:
+            summary = load_url_summary(short_code)
+        if summary is not None:
+            return summary
+
+    pipeline = get_stats_pipeline(short_code)
+    if is_emoji:
+        url_data = aggregate_emoji_url(pipeline)
+    else:
+        url_data = aggregate_url(pipeline)
+
+    if url_data and stats_rollup:
+        stats_rollup.mark(is_emoji, short_code)
+    return url_data
+
+
+def load_stats_version(short_code, is_emoji):
+    """
+    Return the click count, last click and route fields of the document
+    load_stats reads for a link, or None if it doesn't exist.
+    """
+    load_version = load_emoji_url_stats_version if is_emoji else load_url_stats_version
+    version = None
+    if stats_rollup:
+        version = load_version(short_code, summary=True)
+    if version is None:
+        version = load_version(short_code)
+    return version
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from collections import namedtuple
+from importlib.metadata import version
+from crawlerdetect import CrawlerDetect
+from user_agents import parse
+from utils.cache_utils import LRUCache
+from utils.metrics_utils import stage_duration
+from utils.url_utils import BOT_USER_AGENTS, sanitize_key
+
+UA_CACHE_SIZE = int(os.environ.get("UA_CACHE_SIZE", 20000))
+# optional json file the cache is saved to on shutdown and loaded from on start
+UA_CACHE_SNAPSHOT = os.environ.get("UA_CACHE_SNAPSHOT")
+
+_crawler_detect = CrawlerDetect()
+
+REGEX_METACHARACTERS = set(".^$*+?{}[]|()")
+
+
+def _as_literal(pattern):
+    """
+    Return the text matched by ``pattern`` if it is a plain string (escaped
+    punctuation is allowed), otherwise ``None``.
+    """
+    literal = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == "\\":
+            char = next(chars, "")
+            if not char or char.isalnum():
+                return None
+        elif char in REGEX_METACHARACTERS:
+            return None
+        literal.append(char)
+    return "".join(literal)
+
+
+def _trie_regex(words):
+    """
+    Build a regex matching any of ``words`` with shared prefixes factored out,
+    so the engine follows a single branch per position instead of trying every
+    word in turn.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def to_regex(node):
+        optional = "" in node
+        branches = [
+            re.escape(char) + to_regex(child) for char, child in node.items() if char
+        ]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        return f"(?:{'|'.join(branches)}){'?' if optional else ''}"
+
+    return to_regex(trie)
+
+
+def _combine(patterns):
+    literals = []
+    regexes = []
+    for pattern in patterns:
+        literal = _as_literal(pattern)
+        if literal:
+            literals.append(literal.lower())
+        else:
+            regexes.append(f"(?:{pattern})")
+    return "|".join(([_trie_regex(literals)] if literals else []) + regexes)
+
+
+def _build_bot_matcher(bot_patterns, crawler_patterns):
+    """
+    Combine the named bot patterns and the CrawlerDetect patterns into one
+    regex. Named bots are looked for first, across the whole user agent, to
+    keep the precedence of the old per-bot loop.
+    """
+    return re.compile(
+        rf"^(?:(?=.*?(?P<bot>{_combine(bot_patterns)}))|(?=.*?(?P<crawler>{_combine(crawler_patterns)})))",
+        re.IGNORECASE | re.DOTALL,
+    )
+
+
+BOT_MATCHER = _build_bot_matcher(BOT_USER_AGENTS, _crawler_detect.crawlers.getAll())
+CRAWLER_EXCLUSIONS = re.compile(_crawler_detect.compiledExclusions, re.IGNORECASE)
+
+_BOT_NAMES = {}
+_BOT_REGEXES = []
+for _bot in BOT_USER_AGENTS:
+    _literal = _as_literal(_bot)
+    if _literal:
+        _BOT_NAMES.setdefault(_literal.lower(), sanitize_key(_bot))
+    else:
+        _BOT_REGEXES.append((re.compile(_bot, re.IGNORECASE), sanitize_key(_bot)))
+
+
+def _bot_name(matched):
+    name = _BOT_NAMES.get(matched.lower())
+    if name:
+        return name
+    for bot_re, name in _BOT_REGEXES:
+        if bot_re.fullmatch(matched):
+            return name
+    return sanitize_key(matched)
+
+
+def detect_bot(user_agent):
+    """
+    Return the sanitized name of the bot behind ``user_agent`` or ``None`` for
+    regular browsers. Named bots from ``bot_user_agents.txt`` take the name from
+    the list, other crawlers are reported with the matched part of the user agent.
+    """
+    if not user_agent:
+        return None
+
+    # same pre-processing as CrawlerDetect.isCrawler, none of the exclusions
+    # overlap with the names in bot_user_agents.txt
+    agent = CRAWLER_EXCLUSIONS.sub("", user_agent)
+    if not agent:
+        return None
+
+    match = BOT_MATCHER.match(agent)
+    if match is None:
+        return None
+
+    if match.group("bot") is not None:
+        return _bot_name(match.group("bot"))
+    return sanitize_key(match.group("crawler"))
+
+
+UserAgentInfo = namedtuple(
+    "UserAgentInfo", ["os_family", "browser_family", "bot", "is_crawler"]
+)
+
+ua_cache = LRUCache(UA_CACHE_SIZE)
+
+
+def classify_user_agent(user_agent):
+    """
+    Classify ``user_agent`` into os family, browser family and bot name. Raises
+    TypeError when there is no user agent, like ``user_agents.parse``.
+    """
+    info = ua_cache.get(user_agent)
+    if info is None:
+        ua = parse(user_agent)
+        with stage_duration.time("redirect_url", "bot_detection"):
+            bot = detect_bot(user_agent)
+        info = UserAgentInfo(ua.os.family, ua.browser.family, bot, bot is not None)
+        ua_cache.set(user_agent, info)
+    return info
+
+
+def _snapshot_fingerprint():
+    # a snapshot is only valid for the same parser and bot list
+    digest = hashlib.sha256(BOT_MATCHER.pattern.encode())
+    digest.update(version("ua-parser").encode())
+    return digest.hexdigest()
+
+
+def save_ua_snapshot(path=UA_CACHE_SNAPSHOT):
+    if not path:
+        return
+    snapshot = {
+        "fingerprint": _snapshot_fingerprint(),
+        "entries": [[user_agent, *info] for user_agent, info in ua_cache.items()],
+    }
+    # written next to the snapshot and moved over it, so a crash or another
+    # worker saving at the same time never leaves a half written file
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(snapshot, file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def load_ua_snapshot(path=UA_CACHE_SNAPSHOT):
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, "r") as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError):
+        return
+    if snapshot.get("fingerprint") != _snapshot_fingerprint():
+        return
+    for user_agent, *info in snapshot["entries"][-UA_CACHE_SIZE:]:
+        ua_cache.set(user_agent, UserAgentInfo(*info))
+
+
+load_ua_snapshot()
@@ -1,14 +1,37 @@
+import os
 import re
-import string
+import json
+import hashlib
+import time
 import random
+import functools
+import threading
 from datetime import datetime, timedelta, timezone
 from emojies import EMOJIES
-from urllib.parse import unquote
+from urllib.parse import unquote, urlsplit, urlunsplit
 import emoji
+import tldextract
 import validators
 import geoip2.errors
 import geoip2.database
 from flask import request
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+GEOIP_DATABASE_PATH = os.environ.get(
+    "GEOIP_DATABASE_PATH", "misc/GeoLite2-Country.mmdb"
+)
+GEOIP_CACHE_SIZE = int(os.environ.get("GEOIP_CACHE_SIZE", 65536))
+# how often (in seconds) the database file is checked for a newer version
+GEOIP_RELOAD_INTERVAL = float(os.environ.get("GEOIP_RELOAD_INTERVAL", 60))
+REFERRER_CACHE_SIZE = int(os.environ.get("REFERRER_CACHE_SIZE", 10000))
+
+# characters that can't be part of a mongo field name
+MONGO_KEY_PATTERN = re.compile(r"[.$\x00-\x1F\x7F-\x9F]")
+
+# use the public suffix list snapshot bundled with tldextract, never fetch it
+_tld_extract = tldextract.TLDExtract(cache_dir=None, suffix_list_urls=())
 
 with open("bot_user_agents.txt", "r") as file:
     BOT_USER_AGENTS = file.read()
@@ -17,20 +40,124 @@ with open("bot_user_agents.txt", "r") as file:
     ]
 
 
-def get_country(ip_address):
-    try:
-        reader = geoip2.database.Reader("misc/GeoLite2-Country.mmdb")
+_geoip_lock = threading.Lock()
+_geoip_reader = None
+_geoip_mtime = None
+_geoip_checked_at = None
+
+
+def _refresh_geoip_reader():
+    """
+    Return the process-wide GeoIP reader, reopening it when the database file
+    has been replaced since it was last opened.
+    """
+    global _geoip_reader, _geoip_mtime, _geoip_checked_at
+
+    now = time.monotonic()
+    if (
+        _geoip_checked_at is not None
+        and now - _geoip_checked_at < GEOIP_RELOAD_INTERVAL
+    ):
+        return _geoip_reader
+
+    with _geoip_lock:
+        _geoip_checked_at = now
         try:
-            response = reader.country(ip_address)
-            country = response.country.name
-            return country
-        except geoip2.errors.AddressNotFoundError:
-            return "Unknown"
-        finally:
-            reader.close()
-    except FileNotFoundError:
-        # If the GeoIP database file isn't found, just return "Unknown"
+            mtime = os.path.getmtime(GEOIP_DATABASE_PATH)
+        except OSError:
+            mtime = None
+
+        if mtime != _geoip_mtime or _geoip_reader is None:
+            old_reader = _geoip_reader
+            try:
+                _geoip_reader = geoip2.database.Reader(
+                    GEOIP_DATABASE_PATH, mode=geoip2.database.MODE_MMAP
+                )
+            except (OSError, ValueError):
+                _geoip_reader = None
+            _geoip_mtime = mtime
+            _lookup_country.cache_clear()
+            # lookups already holding the old reader keep working until they
+            # return, the mmap is released once the last reference is gone
+            del old_reader
+
+    return _geoip_reader
+
+
+@functools.lru_cache(maxsize=GEOIP_CACHE_SIZE)
+def _lookup_country(ip_address):
+    reader = _geoip_reader
+    if reader is None:
         return "Unknown"
+    try:
+        return reader.country(ip_address).country.name
+    except (geoip2.errors.AddressNotFoundError, ValueError):
+        return "Unknown"
+
+
+def get_country(ip_address):
+    # If the GeoIP database file isn't found, just return "Unknown"
+    if _refresh_geoip_reader() is None:
+        return "Unknown"
+    return _lookup_country(ip_address)
+
+
+def get_country_cache_info():
+    info = _lookup_country.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "maxsize": info.maxsize,
+    }
+
+
+def sanitize_key(key):
+    return MONGO_KEY_PATTERN.sub("_", key)
+
+
+def get_registered_domain(host):
+    """
+    Return the registered domain of ``host`` (``www.google.co.uk`` ->
+    ``google.co.uk``).
+    """
+    extracted = _tld_extract(host)
+    return (
+        f"{extracted.domain}.{extracted.suffix}"
+        if extracted.suffix
+        else extracted.domain
+    )
+
+
+@functools.lru_cache(maxsize=REFERRER_CACHE_SIZE)
+def _referrer_host_key(host):
+    return sanitize_key(get_registered_domain(host)) or None
+
+
+def get_referrer_key(referrer):
+    """
+    Return the registered domain of ``referrer`` (``www.google.co.uk`` ->
+    ``google_co_uk``), ready to be used as a mongo field name, or ``None``.
+    """
+    if "//" in referrer:
+        try:
+            host = urlsplit(referrer).netloc
+        except ValueError:
+            # malformed header, e.g. an unclosed IPv6 bracket
+            return None
+    else:
+        host = referrer.split("/", 1)[0]
+    return _referrer_host_key(host.rsplit("@", 1)[-1])
+
+
+def get_referrer_cache_info():
+    info = _referrer_host_key.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "maxsize": info.maxsize,
+    }
 
 
 def get_client_ip() -> str:
@@ -78,6 +205,35 @@ def validate_url(url):
     return validators.url(url, skip_ipv4_addr=True, skip_ipv6_addr=True)
 
 
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """
+    Normalize the parts of ``url`` that don't change where it leads: the
+    scheme and host are lowercased, default ports and an empty path dropped.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if ":" in host:
+        host = f"[{host}]"
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    userinfo = parts.netloc.rpartition("@")[0]
+    netloc = f"{userinfo}@{host}" if userinfo else host
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+def get_destination_hash(url, options):
+    """
+    Hash of the normalized destination and the link ``options`` that change
+    how it redirects, identical links share it.
+    """
+    key = json.dumps([normalize_url(url), options], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
 # custom expiration time is currently really buggy and not ready for production
 def validate_expiration_time(expiration_time):
     try:
@@ -119,11 +275,6 @@ def convert_to_gmt(expiration_time):
     return expiration_time
 
 
-def generate_short_code():
-    letters = string.ascii_lowercase + string.ascii_uppercase + string.digits
-    return "".join(random.choice(letters) for i in range(6))
-
-
 def validate_alias(string):
     pattern = r"^[a-zA-Z0-9_-]*$"
     return bool(re.search(pattern, string))
@@ -133,11 +284,47 @@ def generate_emoji_alias():
     return "".join(random.choice(EMOJIES) for _ in range(3))
 
 
+def _build_emoji_trie():
+    """
+    Character trie of every emoji sequence known to the emoji library, ZWJ
+    sequences included.
+    """
+    trie = {}
+    for sequence in emoji.EMOJI_DATA:
+        node = trie
+        for char in sequence:
+            node = node.setdefault(char, {})
+        node[None] = True
+    return trie
+
+
+_EMOJI_TRIE = _build_emoji_trie()
+MAX_EMOJI_ALIAS_LENGTH = 15
+
+
 def validate_emoji_alias(alias):
+    """
+    Tell whether ``alias`` is made of emojis only (at most 15). Same result as
+    splitting it with emoji.emoji_list: every emoji is the longest sequence in
+    the trie starting at that position.
+    """
     alias = unquote(alias)
-    emoji_list = emoji.emoji_list(alias)
-    extracted_emojis = "".join([data["emoji"] for data in emoji_list])
-    if len(extracted_emojis) != len(alias) or len(emoji_list) > 15:
-        return False
-    else:
-        return True
+    # no emoji is plain ascii, regular short codes stop here
+    if alias.isascii():
+        return not alias
+
+    length = len(alias)
+    count = 0
+    i = 0
+    while i < length:
+        node = _EMOJI_TRIE.get(alias[i])
+        if node is None:
+            return False
+        i += 1
+        while i < length and alias[i] in node:
+            node = node[alias[i]]
+            i += 1
+        count += 1
+        if None not in node or count > MAX_EMOJI_ALIAS_LENGTH:
+            return False
+    return True